@@ -1,10 +1,11 @@
 # Para usar este script, instale todas as dependências:
 # pip install Flask opencv-python numpy imageio imageio-ffmpeg Pillow
 
-from flask import Flask, request, send_from_directory, jsonify, render_template
+from flask import Flask, request, send_from_directory, jsonify, render_template, Response
 import cv2
 import numpy as np
 import imageio
+import imageio_ffmpeg
 from PIL import Image, ImageDraw, ImageFont
 import os
 import threading
@@ -13,18 +14,28 @@ from datetime import datetime
 import re
 import zipfile
 import shutil
+import uuid
+import hashlib
+import time
+import multiprocessing
+import subprocess
+import copy
+import queue
+import weakref
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 
 # --- Configurações Globais ---
-preview_lock = threading.Lock()
-
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ASSETS_FOLDER = os.path.join(BASE_DIR, 'assets')
 STATIC_FOLDER = os.path.join(BASE_DIR, 'static')
 TEMPLATES_FOLDER = os.path.join(BASE_DIR, 'templates')
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'output')
+# Caches em disco (renders e identidade decodificada), fora de OUTPUT_FOLDER para não serem servidas por /output/
+CACHE_FOLDER = os.environ.get('URBNEWS_CACHE_FOLDER', os.path.join(BASE_DIR, 'cache'))
 
-PREVIEW_FILE_PATH = os.path.join(STATIC_FOLDER, 'preview.jpg')
 SETTINGS_FILE_PATH = os.path.join(BASE_DIR, 'settings.json')
 
 # Mapeamento de formatos para os seus respetivos ficheiros de assets
@@ -36,187 +47,604 @@ FORMAT_ASSETS = {
     "960x1344": {"label": "TOTEMG", "base": "base_abrigo.webm", "fade": "fade_abrigo.png"}
 }
 
-# --- Motor Gráfico ---
+# Formatos derivados, gerados a partir do vídeo final de um formato base: (label, dimensões, duração em segundos)
+DERIVED_FORMATS = {
+    "WIDEFULLHD": [("WIDE", (1280, 720), 10), ("TER", (1280, 720), 15)],
+    "MUB-FOR-SP": [("LED4", (864, 288), 10)],
+    "VERTFULLHD": [("VERT", (608, 1080), 10)]
+}
+
+# Número de processos usados para renderizar os formatos em paralelo (1 = tudo no processo do servidor)
+RENDER_WORKERS = max(1, int(os.environ.get('URBNEWS_RENDER_WORKERS', os.cpu_count() or 1)))
+# Os processos de render (e o Manager do progresso) não são criados por fork: um fork feito a partir de uma
+# thread de job herdaria trancado qualquer lock que uma thread de preview tivesse nesse instante
+# (_texto_lock, asset_cache.lock...) e ficaria bloqueado para sempre. O forkserver parte de um processo limpo.
+MP_CONTEXTO = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+# Número de jobs de renderização que correm ao mesmo tempo; os restantes ficam em fila
+RENDER_JOB_SLOTS = max(1, int(os.environ.get('URBNEWS_RENDER_JOB_SLOTS', 1)))
+# Threads de composição dentro do render de um formato (o OpenCV e o NumPy largam o GIL) e número de frames
+# de saída em circulação entre a composição e o encoder. Cada thread tem os seus buffers (~50 MB em 1080x1920)
+# e cada frame em voo ocupa um frame de saída (~6 MB), o que limita a memória usada por formato.
+COMPOSITOR_THREADS = max(1, int(os.environ.get('URBNEWS_COMPOSITOR_THREADS', (os.cpu_count() or 1) // min(RENDER_WORKERS, len(FORMAT_ASSETS)))))
+FRAMES_EM_VOO = max(1, int(os.environ.get('URBNEWS_FRAMES_EM_VOO', COMPOSITOR_THREADS + 2)))
+# Quantos frames cada vídeo de origem é decodificado à frente da composição
+PREFETCH_FRAMES = 4
+
+# Quantos jobs terminados são mantidos em memória para consulta
+MAX_JOBS_GUARDADOS = 50
+# De quantos em quantos frames o progresso é publicado e o cancelamento verificado
+PROGRESSO_INTERVALO = 10
+
+# Cache de renders em cache/renders: um formato cujos parâmetros efetivos, mídia e assets não mudaram é
+# copiado de lá em vez de ser renderizado outra vez. As entradas sem uso há mais de RENDER_CACHE_DIAS são
+# apagadas e, acima de RENDER_CACHE_MB, as menos usadas também (0 MB desliga a cache).
+RENDER_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'renders')
+RENDER_CACHE_MB = int(os.environ.get('URBNEWS_RENDER_CACHE_MB', 2048))
+RENDER_CACHE_DIAS = float(os.environ.get('URBNEWS_RENDER_CACHE_DIAS', 7))
+# Incrementar quando o compositor passa a gerar frames diferentes, para não reutilizar renders antigos
+RENDER_CACHE_VERSAO = 2
+# Chaves do settings.json que não afetam o vídeo de um formato
+PARAMS_FORA_DA_CACHE = ('formats', 'selectedFormat', 'userMediaOriginalFilename')
+
+# Frames visíveis da identidade animada, decodificados uma vez por (formato, fps) para um .npy em BGR à
+# resolução de saída. Os renders abrem-no em memory-map: todos os processos partilham as mesmas páginas.
+# Acima de IDENTIDADE_CACHE_MB são apagados os ficheiros usados há mais tempo (o que acabou de ser gerado fica sempre).
+IDENTIDADE_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'identidade')
+IDENTIDADE_CACHE_MB = int(os.environ.get('URBNEWS_IDENTIDADE_CACHE_MB', 3072))
+
+# Memória máxima (MB) ocupada pela cache de assets decodificados de cada processo
+ASSET_CACHE_MB = int(os.environ.get('URBNEWS_ASSET_CACHE_MB', 512))
+
+# Fração do tamanho de saída usada no preview (1.0 = resolução final) e qualidade do JPEG devolvido
+PREVIEW_SCALE = min(1.0, max(0.1, float(os.environ.get('URBNEWS_PREVIEW_SCALE', 0.5))))
+PREVIEW_JPEG_QUALITY = 85
+
+# Parâmetros medidos em pixels da saída (com o valor por omissão usado no compositor) e
+# parâmetros que são fatores de escala sobre o tamanho original da mídia/logo/fonte
+PARAMS_EM_PIXELS = {'posXFundo': 0, 'posYFundo': 0, 'posXLogo': 0, 'posYLogo': 0, 'posXMascara': 0, 'posXTitulo': 1000, 'posYTitulo': 280,
+                    'fontSizeTitulo': 85, 'letterSpacingTitulo': 0, 'lineSpacingTitulo': 4, 'posXRetranca': None, 'posYRetranca': None}
+PARAMS_DE_ESCALA = {'escalaFundo': 1.0, 'escalaLogo': 1.0, 'escalaRetranca': 1.0}
+
+# Qualidade do blur do fundo: 'exata' é o GaussianBlur à resolução final; as outras desfocam a uma
+# resolução reduzida (potência de 2, até 1/8) enquanto o sigma reduzido não descer do mínimo indicado.
+# Erro máximo aceite face a 'exata' (níveis 0-255) em todos os tamanhos de FORMAT_ASSETS, blur 25-151, verificado
+# pelo benchmark.py; o máximo isolado aparece só em contornos nítidos. 'alta' fica 2-25x mais rápida para
+# blur ≥ 45, 'rapida' (só preview) ainda mais.
+BLUR_QUALIDADES = {'exata': None, 'alta': 3.0, 'rapida': 2.0}
+BLUR_LIMITES_ERRO = {'alta': {'media': 0.3, 'p99': 2, 'max': 16}, 'rapida': {'media': 0.5, 'p99': 4, 'max': 24}}
+BLUR_QUALIDADE_RENDER = os.environ.get('URBNEWS_BLUR_RENDER', 'alta')
+BLUR_QUALIDADE_PREVIEW = os.environ.get('URBNEWS_BLUR_PREVIEW', 'rapida')
+
+# Opções de codificação por omissão. Podem ser alteradas em settings.json, no topo ("encoder") ou por
+# formato (formats[formato].encoder). backend: 'ffmpeg' (H.264 pelo binário do imageio-ffmpeg) ou 'opencv'
+# (cv2.VideoWriter com o fourcc indicado). Com 'bitrate' (ex.: "6M") o CRF é ignorado; threads 0 = automático.
+ENCODER_PADRAO = {'backend': os.environ.get('URBNEWS_ENCODER', 'ffmpeg'), 'codec': 'libx264', 'preset': 'veryfast',
+                  'crf': 20, 'bitrate': None, 'threads': 0, 'pixFmt': 'yuv420p', 'fourcc': 'mp4v'}
+
+# Amostras (uma por frame) guardadas por formato e etapa para os quantis de /metrics
+METRICAS_AMOSTRAS = 4096
+
+# Janela (em segundos) em que a identidade animada desaparece por cima da composição
+IDENTIDADE_FADE_INICIO, IDENTIDADE_FADE_FIM = 3.0, 3.5
+
+# --- Cache de Assets ---
+
+class CacheDeAssets:
+    # Cache LRU partilhada pelo processo inteiro (preview e render). As chaves incluem o mtime
+    # do ficheiro de origem, por isso um ficheiro alterado nunca devolve a versão antiga; as
+    # entradas menos usadas são descartadas quando o total passa do orçamento de memória.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entradas = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    def obter(self, tipo, path, extra, carregar):
+        chave = (tipo, path, os.path.getmtime(path), extra)
+        with self.lock:
+            if chave in self.entradas:
+                self.entradas.move_to_end(chave)
+                return self.entradas[chave][0]
+        valor = carregar()
+        arrays = [v for v in (valor if isinstance(valor, tuple) else (valor,)) if isinstance(v, np.ndarray)]
+        tamanho = sum(a.nbytes for a in arrays) if arrays else os.path.getsize(path)
+        for a in arrays: a.setflags(write=False)
+        if tamanho > self.max_bytes: return valor
+        with self.lock:
+            if chave not in self.entradas:
+                self.entradas[chave] = (valor, tamanho)
+                self.total_bytes += tamanho
+            while self.total_bytes > self.max_bytes:
+                _, (_, tamanho_antigo) = self.entradas.popitem(last=False)
+                self.total_bytes -= tamanho_antigo
+        return valor
+
+asset_cache = CacheDeAssets(ASSET_CACHE_MB * 1024 * 1024)
+
+def is_video_file(path):
+    return '.' in path and path.rsplit('.', 1)[1].lower() in ['mp4', 'webm', 'mov']
+
+def carregar_imagem(path, flags=cv2.IMREAD_UNCHANGED):
+    # As imagens devolvidas são partilhadas e só de leitura
+    def carregar():
+        img = cv2.imread(path, flags)
+        if img is None: raise ValueError(f"Não foi possível ler {os.path.basename(path)}")
+        return img
+    return asset_cache.obter('imagem', path, flags, carregar)
+
+def carregar_fade(path, final_dimensions):
+    # Fade já redimensionado para o tamanho de saída
+    def carregar():
+        img_fade = carregar_imagem(path)
+        frame_width, frame_height = final_dimensions
+        if img_fade.shape[:2] == (frame_height, frame_width): return img_fade.copy()
+        return cv2.resize(img_fade, (frame_width, frame_height), interpolation=cv2.INTER_AREA)
+    return asset_cache.obter('fade', path, tuple(final_dimensions), carregar)
+
+def carregar_primeiro_frame(path):
+    # Primeiro frame (BGR) da mídia do utilizador, seja vídeo ou imagem
+    if not is_video_file(path): return carregar_imagem(path, cv2.IMREAD_COLOR)
+    def carregar():
+        reader = imageio.get_reader(path)
+        try: return cv2.cvtColor(reader.get_data(0), cv2.COLOR_RGB2BGR)
+        finally: reader.close()
+    return asset_cache.obter('primeiro_frame', path, None, carregar)
+
+def carregar_fonte(path, size):
+    return asset_cache.obter('fonte', path, size, lambda: ImageFont.truetype(path, size))
+
+def carregar_settings():
+    if not os.path.exists(SETTINGS_FILE_PATH): return {}
+    # Devolve uma cópia: quem chama pode alterar o dicionário à vontade
+    return copy.deepcopy(asset_cache.obter('settings', SETTINGS_FILE_PATH, None, lambda: json.load(open(SETTINGS_FILE_PATH))))
+
+# --- Métricas ---
+# Tempos por etapa: uma amostra (perf_counter) por frame em cada camada e em cada etapa de I/O.
+# Um Cronometro acompanha um render; o resumo vai na resposta e as amostras alimentam as
+# métricas do processo do servidor, expostas em /metrics no formato de texto do Prometheus.
+
+class Cronometro:
+    def __init__(self):
+        self.amostras = {}
+
+    def registar(self, etapa, segundos):
+        # list.append é atómico: várias threads de composição podem registar ao mesmo tempo
+        lista = self.amostras.get(etapa)
+        if lista is None: lista = self.amostras.setdefault(etapa, [])
+        lista.append(segundos)
+
+def resumir_tempos(amostras, frames, segundos):
+    etapas = {}
+    for etapa, valores in amostras.items():
+        p50, p95 = np.percentile(valores, [50, 95])
+        etapas[etapa] = {"p50_ms": round(p50 * 1000, 3), "p95_ms": round(p95 * 1000, 3), "total_s": round(sum(valores), 3), "n": len(valores)}
+    return {"frames": frames, "segundos": round(segundos, 3), "fps": round(frames / segundos, 2) if segundos else None, "etapas": etapas}
+
+class MetricasRender:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.etapas = {}
+        self.fps = {}
+        self.renders = {}
+        # Agregado por job (todos os formatos renderizados): amostras por etapa e frames/s do último job
+        self.etapas_job = {}
+        self.job_fps = None
 
-def overlay_image(background, overlay, x, y, scale):
+    def registar_render(self, label, estado, amostras=None, frames=0, segundos=0.0):
+        with self.lock:
+            self.renders[(label, estado)] = self.renders.get((label, estado), 0) + 1
+            if segundos: self.fps[label] = frames / segundos
+        self.registar_amostras(label, amostras or {})
+
+    def registar_amostras(self, label, amostras):
+        with self.lock:
+            for etapa, valores in amostras.items(): self._acumular(self.etapas, (label, etapa), valores)
+
+    def registar_job(self, amostras, frames, segundos):
+        with self.lock:
+            if segundos and frames: self.job_fps = frames / segundos
+            for etapa, valores in amostras.items(): self._acumular(self.etapas_job, etapa, valores)
+
+    def _acumular(self, etapas, chave, valores):
+        entrada = etapas.get(chave)
+        if entrada is None: entrada = etapas[chave] = {"amostras": deque(maxlen=METRICAS_AMOSTRAS), "soma": 0.0, "n": 0}
+        entrada["amostras"].extend(valores)
+        entrada["soma"] += sum(valores)
+        entrada["n"] += len(valores)
+
+    def _resumo(self, nome, rotulos, entrada):
+        linhas = [f'{nome}{{{rotulos},quantile="{q}"}} {valor:.6f}' for q, valor in zip(("0.5", "0.95"), np.percentile(entrada["amostras"], [50, 95]))]
+        return linhas + [f'{nome}_sum{{{rotulos}}} {entrada["soma"]:.6f}', f'{nome}_count{{{rotulos}}} {entrada["n"]}']
+
+    def prometheus(self):
+        with self.lock:
+            linhas = ["# HELP urbnews_stage_seconds Duração por frame de cada camada e etapa de I/O do render.", "# TYPE urbnews_stage_seconds summary"]
+            for (label, etapa), entrada in sorted(self.etapas.items()):
+                linhas += self._resumo('urbnews_stage_seconds', f'format="{label}",stage="{etapa}"', entrada)
+            linhas += ["# HELP urbnews_job_stage_seconds Duração por frame de cada etapa, agregada sobre todos os formatos dos jobs.", "# TYPE urbnews_job_stage_seconds summary"]
+            for etapa, entrada in sorted(self.etapas_job.items()):
+                linhas += self._resumo('urbnews_job_stage_seconds', f'stage="{etapa}"', entrada)
+            linhas += ["# HELP urbnews_job_fps Frames por segundo do último job (frames renderizados em todos os formatos / duração do job).", "# TYPE urbnews_job_fps gauge"]
+            if self.job_fps is not None: linhas.append(f'urbnews_job_fps {self.job_fps:.3f}')
+            linhas += ["# HELP urbnews_render_fps Frames por segundo do último render de cada formato.", "# TYPE urbnews_render_fps gauge"]
+            linhas += [f'urbnews_render_fps{{format="{label}"}} {fps:.3f}' for label, fps in sorted(self.fps.items())]
+            linhas += ["# HELP urbnews_renders_total Renders por formato e estado (ok, cache, error).", "# TYPE urbnews_renders_total counter"]
+            linhas += [f'urbnews_renders_total{{format="{label}",status="{estado}"}} {n}' for (label, estado), n in sorted(self.renders.items())]
+        return "\n".join(linhas) + "\n"
+
+metricas = MetricasRender()
+
+def juntar_amostras(base_results):
+    # Amostras de todos os formatos renderizados de um job, juntas por etapa, e o total de frames
+    amostras, frames = {}, 0
+    for res in base_results:
+        if "amostras" not in res: continue
+        amostras_formato, frames_formato, _ = res["amostras"]
+        for etapa, valores in amostras_formato.items(): amostras.setdefault(etapa, []).extend(valores)
+        frames += frames_formato
+    return amostras, frames
+
+def separar_timings(base_results, segundos):
+    # Bloco 'timings' de uma resposta: o resumo do job inteiro (etapas de todos os formatos renderizados,
+    # frames/s = frames renderizados / tempo total) e, em 'formats', o de cada formato. Tira dos resultados
+    # 'timings' e 'amostras', que não seguem na resposta.
+    timings = {**resumir_tempos(*juntar_amostras(base_results), segundos), "formats": {res["label"]: res.pop("timings") for res in base_results if "timings" in res}}
+    for res in base_results: res.pop("amostras", None)
+    return timings
+
+# --- Kernels de Composição ---
+# Misturas em aritmética inteira (uint8 com intermédios uint16), escritas em buffers reutilizados.
+# Os resultados ficam a ±1 LSB da antiga versão em vírgula flutuante.
+
+_cache_identidade = {}
+
+def cache_por_identidade(obj, extra, calcular):
+    # Guarda um valor derivado de um array enquanto esse mesmo objeto existir (ex.: fator do fade)
+    chave = (id(obj), extra)
+    entrada = _cache_identidade.get(chave)
+    if entrada is not None and entrada[0]() is obj: return entrada[1]
+    valor = calcular()
+    _cache_identidade[chave] = (weakref.ref(obj, lambda _, chave=chave: _cache_identidade.pop(chave, None)), valor)
+    return valor
+
+def criar_buffers(final_dimensions):
+    # Buffers de um formato, reutilizados de frame para frame durante um render
+    frame_width, frame_height = final_dimensions
+    shape = (frame_height, frame_width, 3)
+    return {'redimensionado': np.empty(shape, np.uint8), 'fundo': np.empty(shape, np.uint8), 'fade': np.empty(shape, np.uint8),
+            'final': np.empty(shape, np.uint8), 'tmp': np.empty(shape, np.uint16), 'tmp2': np.empty(shape, np.uint16),
+            'alfa_inv': np.empty((frame_height, frame_width, 1), np.uint8)}
+
+def _scratch(buffers, nome, shape, dtype):
+    if buffers is None: return np.empty(shape, dtype)
+    return buffers[nome][:shape[0], :shape[1]]
+
+def dividir_por_255(x, out):
+    # floor(x / 255) sem divisão, exato para 0 <= x <= 65152 (x e out em uint16, objetos diferentes)
+    np.right_shift(x, 8, out=out)
+    out += x
+    out += 1
+    out >>= 8
+
+def mesclar_alfa(dst, src_bgr, alfa, buffers=None):
+    # dst = floor((src * a + dst * (255 - a)) / 255), no próprio dst; alfa em uint8 com forma (h, w, 1)
+    tmp, tmp2 = _scratch(buffers, 'tmp', dst.shape, np.uint16), _scratch(buffers, 'tmp2', dst.shape, np.uint16)
+    alfa_inv = _scratch(buffers, 'alfa_inv', alfa.shape, np.uint8)
+    np.subtract(255, alfa, out=alfa_inv)
+    np.multiply(src_bgr, alfa, out=tmp, dtype=np.uint16)
+    np.multiply(dst, alfa_inv, out=tmp2, dtype=np.uint16)
+    tmp += tmp2
+    dividir_por_255(tmp, tmp2)
+    np.copyto(dst, tmp2, casting='unsafe')
+
+def premultiplicar(bgra):
+    # (cor * alfa, 255 - alfa) em uint16, a forma usada por mesclar_premultiplicado
+    alfa = bgra[:, :, 3:4]
+    return np.multiply(bgra[:, :, :3], alfa, dtype=np.uint16), 255 - alfa.astype(np.uint16)
+
+def mesclar_premultiplicado(dst, cor_alfa, alfa_inv, buffers=None, arredondar=False):
+    # dst = (dst * (255 - a) + cor * a) / 255, no próprio dst; arredondar=True arredonda em vez de truncar
+    tmp, tmp2 = _scratch(buffers, 'tmp', dst.shape, np.uint16), _scratch(buffers, 'tmp2', dst.shape, np.uint16)
+    np.multiply(dst, alfa_inv, out=tmp, dtype=np.uint16)
+    tmp += cor_alfa
+    if arredondar: tmp += 127
+    dividir_por_255(tmp, tmp2)
+    np.copyto(dst, tmp2, casting='unsafe')
+
+def preparar_fade(img_fade, final_dimensions):
+    # O multiply do fade com o seu alfa equivale a um fator por pixel: (f * a + 255 * (255 - a)) / 255².
+    # Guardado em ponto fixo (256 = 1.0) para que canvas * fator caiba em uint16.
+    def calcular():
+        frame_width, frame_height = final_dimensions
+        fade = img_fade
+        if fade.shape[:2] != (frame_height, frame_width):
+            fade = cv2.resize(fade, (frame_width, frame_height), interpolation=cv2.INTER_AREA)
+        fade_bgr, fade_alpha = fade[:, :, :3].astype(np.int32), fade[:, :, 3:4].astype(np.int32)
+        fator = ((fade_bgr * fade_alpha + 255 * (255 - fade_alpha)) * 256 + 65025 // 2) // 65025
+        fator = fator.astype(np.uint16)
+        fator.setflags(write=False)
+        return fator
+    return cache_por_identidade(img_fade, tuple(final_dimensions), calcular)
+
+def multiplicar_fade(canvas, fator, out, buffers=None):
+    tmp = _scratch(buffers, 'tmp', canvas.shape, np.uint16)
+    np.multiply(canvas, fator, out=tmp, dtype=np.uint16)
+    tmp >>= 8
+    np.copyto(out, tmp, casting='unsafe')
+    return out
+
+def _area_visivel(background, w, h, x, y):
+    # Fatias (destino, origem) da parte de uma imagem w×h em (x, y) que cai dentro do fundo, ou None
+    h_bg, w_bg = background.shape[:2]
+    x, y = int(x), int(y)
+    x1_dest, y1_dest = max(0, x), max(0, y)
+    x2_dest, y2_dest = min(w_bg, x + w), min(h_bg, y + h)
+    if (x2_dest - x1_dest) <= 0 or (y2_dest - y1_dest) <= 0: return None
+    x1_src, y1_src = max(0, -x), max(0, -y)
+    dest = (slice(y1_dest, y2_dest), slice(x1_dest, x2_dest))
+    src = (slice(y1_src, y1_src + y2_dest - y1_dest), slice(x1_src, x1_src + x2_dest - x1_dest))
+    return dest, src
+
+def overlay_image(background, overlay, x, y, scale, buffers=None):
     if scale <= 0: return background
     h_overlay, w_overlay, _ = overlay.shape
     w_scaled, h_scaled = int(w_overlay * scale), int(h_overlay * scale)
     if w_scaled <= 0 or h_scaled <= 0: return background
     
-    overlay_resized = cv2.resize(overlay, (w_scaled, h_scaled), interpolation=cv2.INTER_AREA)
-
-    h_bg, w_bg, _ = background.shape
-    overlay_bgr, overlay_alpha = overlay_resized[:, :, 0:3], overlay_resized[:, :, 3] / 255.0
-    
-    x, y = int(x), int(y)
+    overlay_resized = overlay if (w_scaled, h_scaled) == (w_overlay, h_overlay) else cv2.resize(overlay, (w_scaled, h_scaled), interpolation=cv2.INTER_AREA)
+    area = _area_visivel(background, w_scaled, h_scaled, x, y)
+    if area is None: return background
+    dest, src = area
+    mesclar_alfa(background[dest], overlay_resized[src][:, :, 0:3], overlay_resized[src][:, :, 3:4], buffers)
+    return background
 
-    x1_dest, y1_dest = max(0, x), max(0, y)
-    x2_dest, y2_dest = min(w_bg, x + w_scaled), min(h_bg, y + h_scaled)
-    x1_src, y1_src = max(0, -x), max(0, -y)
-    
-    if (x2_dest - x1_dest) > 0 and (y2_dest - y1_dest) > 0:
-        dest_w, dest_h = x2_dest - x1_dest, y2_dest - y1_dest
-        x2_src, y2_src = x1_src + dest_w, y1_src + dest_h
-        
-        y1_dest, y2_dest, x1_dest, x2_dest = int(y1_dest), int(y2_dest), int(x1_dest), int(x2_dest)
-        y1_src, y2_src, x1_src, x2_src = int(y1_src), int(y2_src), int(x1_src), int(x2_src)
-
-        roi = background[y1_dest:y2_dest, x1_dest:x2_dest]
-        alpha_mask = cv2.merge([overlay_alpha[y1_src:y2_src, x1_src:x2_src]] * 3)
-        bgr_src = overlay_bgr[y1_src:y2_src, x1_src:x2_src]
-        composite = (bgr_src * alpha_mask) + (roi * (1.0 - alpha_mask))
-        background[y1_dest:y2_dest, x1_dest:x2_dest] = composite
+def overlay_premultiplicado(background, overlay, x, y, scale, buffers=None, path=None):
+    # Como overlay_image, para imagens fixas (logo): com o path do ficheiro de origem, o redimensionamento
+    # e a pré-multiplicação ficam na cache de assets (uma entrada por tamanho, dentro de ASSET_CACHE_MB)
+    if scale <= 0: return background
+    h_overlay, w_overlay, _ = overlay.shape
+    w_scaled, h_scaled = int(w_overlay * scale), int(h_overlay * scale)
+    if w_scaled <= 0 or h_scaled <= 0: return background
+    calcular = lambda: premultiplicar(cv2.resize(overlay, (w_scaled, h_scaled), interpolation=cv2.INTER_AREA))
+    cor_alfa, alfa_inv = asset_cache.obter('logo_premultiplicado', path, (w_scaled, h_scaled), calcular) if path else calcular()
+    area = _area_visivel(background, w_scaled, h_scaled, x, y)
+    if area is None: return background
+    dest, src = area
+    mesclar_premultiplicado(background[dest], cor_alfa[src], alfa_inv[src], buffers)
     return background
 
+# --- Motor Gráfico ---
+
+# Métricas de glifos por (fonte, tamanho): avanço de cada carácter e altura de linha
+_metricas_glifos = {}
+
+def metricas_da_fonte(font):
+    chave = (getattr(font, 'path', id(font)), getattr(font, 'size', None))
+    metricas = _metricas_glifos.get(chave)
+    if metricas is None:
+        metricas = _metricas_glifos[chave] = {}
+    return metricas
+
+def avanco_glifo(font, char):
+    metricas = metricas_da_fonte(font)
+    if char not in metricas:
+        metricas[char] = font.getbbox(char)[2] if hasattr(font, 'getbbox') else font.getsize(char)[0]
+    return metricas[char]
+
+def altura_linha(font):
+    metricas = metricas_da_fonte(font)
+    if None not in metricas:
+        metricas[None] = font.getbbox("A")[3] if hasattr(font, 'getbbox') else font.getsize("A")[1]
+    return metricas[None]
+
 def draw_text_with_tracking(draw, pos, text, font, fill, tracking=0):
     x, y = pos
     for char in text:
         draw.text((x, y), char, font=font, fill=fill)
-        char_width = font.getbbox(char)[2] if hasattr(font, 'getbbox') else font.getsize(char)[0]
-        x += char_width + tracking
+        x += avanco_glifo(font, char) + tracking
 
 def wrap_text(text, font, max_width, tracking=0):
+    # Largura de uma linha = soma de (avanço + tracking) dos carácteres, menos o último tracking.
+    # As larguras de cada palavra e do espaço são calculadas uma vez e acumuladas: custo linear.
     lines, words = [], text.split(' ')
-    def get_line_width(line_text):
-        if not line_text: return 0
-        width = sum(font.getbbox(char)[2] + tracking for char in line_text) if hasattr(font, 'getbbox') else sum(font.getsize(char)[0] + tracking for char in line_text)
-        return width - tracking if width > 0 else 0
+    word_widths = [sum(avanco_glifo(font, char) + tracking for char in word) for word in words]
+    space_width = avanco_glifo(font, ' ') + tracking
     i = 0
     while i < len(words):
-        line = ''
-        while i < len(words) and get_line_width(line + words[i]) <= max_width:
+        line, line_width = '', 0
+        while i < len(words):
+            width = line_width + word_widths[i]
+            if (width - tracking if width > 0 else 0) > max_width: break
             line += words[i] + " "
+            line_width = width + space_width
             i += 1
         if not line: line = words[i]; i += 1
         lines.append(line.strip())
     return lines
 
-# --- NOVA FUNÇÃO PARA CRIAR A MÁSCARA DE BORDA ---
+# --- MÁSCARA DE BORDA ---
 def create_edge_fade_mask(width, height, rotation, position_offset, fade_intensity):
-    # Cria uma tela grande para evitar cortes na rotação
-    diag = int(np.sqrt(width**2 + height**2))
-    mask = np.zeros((diag, diag), dtype=np.uint8)
-    
+    # Equivale a desenhar uma rampa horizontal (opaco -> transparente) numa tela quadrada do tamanho da
+    # diagonal, rodá-la e recortar o centro; mas amostra a rampa diretamente no tamanho final, com uma
+    # única transformação inversa sobre o perfil de uma linha da tela.
     # A intensidade (0 a 1) controla a largura do fade. Multiplicamos por 2 para um efeito mais visível.
     fade_width = int(width * fade_intensity * 2)
     if fade_width < 1: # Se a intensidade for 0, a máscara será totalmente opaca
-        mask.fill(255)
-    else:
-        # A posição (offset) move a "linha imaginária" (o centro do fade)
-        fade_center = (diag // 2) + position_offset
-        opaque_end = fade_center - (fade_width // 2)
-        
-        # --- CORREÇÃO DO ERRO ---
-        # Garante que os índices de slice sejam inteiros
-        opaque_end_int = int(opaque_end)
-        
-        # Preenche a parte totalmente opaca (branca)
-        mask[:, :max(0, opaque_end_int)] = 255
-        
-        # Cria o gradiente (branco para preto)
-        gradient_zone = np.linspace(255, 0, fade_width, dtype=np.uint8)
-        for i in range(fade_width):
-            col_index = opaque_end_int + i
-            if 0 <= col_index < diag:
-                mask[:, col_index] = gradient_zone[i]
-            
-    # Rotaciona a máscara
-    center = (diag // 2, diag // 2)
-    rot_mat = cv2.getRotationMatrix2D(center, rotation, 1.0)
-    rotated_mask = cv2.warpAffine(mask, rot_mat, (diag, diag), flags=cv2.INTER_LINEAR)
-    
-    # Corta o centro da máscara rotacionada para o tamanho da imagem original
-    crop_x = (diag - width) // 2
-    crop_y = (diag - height) // 2
-    final_mask = rotated_mask[crop_y:crop_y + height, crop_x:crop_x + width]
-    
-    return final_mask
+        return np.full((height, width), 255, dtype=np.uint8)
+
+    diag = int(np.sqrt(width**2 + height**2))
+    centro = diag // 2
+    # A posição (offset) move a "linha imaginária" (o centro do fade)
+    opaque_end = int(centro + position_offset - (fade_width // 2))
+
+    # Perfil de uma linha da tela, com uma coluna transparente de cada lado (a borda da tela)
+    perfil = np.zeros((1, diag + 2), dtype=np.uint8)
+    perfil[0, 1:1 + max(0, min(diag, opaque_end))] = 255
+    cols = np.arange(opaque_end, opaque_end + fade_width)
+    valid = (cols >= 0) & (cols < diag)
+    perfil[0, cols[valid] + 1] = np.linspace(255, 0, fade_width, dtype=np.uint8)[valid]
+
+    # Coluna da tela (antes da rotação) de cada pixel do resultado: x = cos * u - sin * v + c
+    theta = np.deg2rad(rotation)
+    cos, sin = np.cos(theta), np.sin(theta)
+    if abs(cos) < 1e-9: cos = 0.0
+    if abs(sin) < 1e-9: sin = 0.0
+    crop_x, crop_y = (diag - width) // 2, (diag - height) // 2
+    c = cos * (crop_x - centro) - sin * (crop_y - centro) + centro + 1
+    flags, border = cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP, cv2.BORDER_REPLICATE
+
+    # Rotações múltiplas de 90°: a máscara só varia numa direção, basta uma linha ou coluna
+    if sin == 0.0:
+        linha = cv2.warpAffine(perfil, np.array([[cos, 0, c], [0, 0, 0]]), (width, 1), flags=flags, borderMode=border)
+        return np.broadcast_to(linha, (height, width))
+    if cos == 0.0:
+        coluna = cv2.warpAffine(perfil, np.array([[-sin, 0, c], [0, 0, 0]]), (height, 1), flags=flags, borderMode=border)
+        return np.broadcast_to(coluna.reshape(height, 1), (height, width))
+    return cv2.warpAffine(perfil, np.array([[cos, -sin, c], [0, 0, 0]]), (width, height), flags=flags, borderMode=border)
+
+@functools.lru_cache(maxsize=16)
+def mascara_borda(width, height, rotation, position_offset, fade_intensity):
+    # Os parâmetros não mudam durante um render: a máscara é calculada uma vez e partilhada (preview e render)
+    mask = create_edge_fade_mask(width, height, rotation, position_offset, fade_intensity)
+    if mask.flags.writeable: mask.setflags(write=False)
+    return mask
+
+def calcular_opacidade_identidade(frame_count, fps):
+    fade_start_time, fade_end_time = IDENTIDADE_FADE_INICIO, IDENTIDADE_FADE_FIM
+    current_time = frame_count / fps
+    if current_time >= fade_end_time: return 0.0
+    if current_time > fade_start_time: return 1.0 - ((current_time - fade_start_time) / (fade_end_time - fade_start_time))
+    return 1.0
 
-def processar_frame(frame_fundo_bgr_original, img_logo, frame_identidade_bgr, img_fade, frame_count, fps, params, final_dimensions, format_key):
+def aplicar_identidade(frame_com_texto, frame_identidade_bgr, frame_count, fps, final_dimensions, out=None):
+    # Camada 8: Identidade Visual Animada (escrita em 'out', se indicado)
+    if frame_identidade_bgr is None: return frame_com_texto
     frame_width, frame_height = final_dimensions
-    
+    fade_opacity = calcular_opacidade_identidade(frame_count, fps)
+    if fade_opacity <= 0.0: return frame_com_texto
+    if frame_identidade_bgr.shape[:2] != (frame_height, frame_width): frame_identidade_bgr = cv2.resize(frame_identidade_bgr, (frame_width, frame_height))
+    return cv2.addWeighted(frame_identidade_bgr, fade_opacity, frame_com_texto, 1.0 - fade_opacity, 0, dst=out)
+
+# --- Grafo de Camadas ---
+# O compositor é um grafo: cada camada declara as camadas de que depende e os parâmetros que lê.
+# Sem memo, avalia tudo (render). Com um memo por sessão de edição (preview), cada camada só é
+# recalculada quando os seus parâmetros ou os de uma camada anterior mudaram.
+# Sem memo, ctx['buffers'] pode trazer os buffers do formato: as camadas escrevem neles e alteram
+# a saída da camada anterior no próprio lugar, em vez de alocar frames novos.
+
+def desfocar_fundo(frame, final_dimensions, blur_amount, qualidade='exata', buffers=None):
+    frame_width, frame_height = final_dimensions
+    # Sigma que o GaussianBlur usa para este tamanho de kernel (sigmaX = 0)
+    sigma = 0.3 * ((blur_amount - 1) * 0.5 - 1) + 0.8
+    sigma_minimo = BLUR_QUALIDADES.get(qualidade)
+    fator = 1
+    while sigma_minimo and fator < 8 and sigma / (fator * 2) >= sigma_minimo: fator *= 2
+
+    if fator == 1:
+        bg_fill = cv2.resize(frame, (frame_width, frame_height), dst=buffers['redimensionado'] if buffers else None, interpolation=cv2.INTER_LINEAR)
+        return cv2.GaussianBlur(bg_fill, (blur_amount, blur_amount), 0, dst=buffers['fundo'] if buffers else None)
+
+    # Reduz, desfoca com o sigma equivalente e volta a ampliar. A redução e a ampliação também
+    # suavizam (~0.25 * fator² de variância), por isso o sigma reduzido é corrigido.
+    pequeno = (max(1, round(frame_width / fator)), max(1, round(frame_height / fator)))
+    h_orig, w_orig = frame.shape[:2]
+    if pequeno[0] <= w_orig and pequeno[1] <= h_orig:
+        reduzido = cv2.resize(frame, pequeno, interpolation=cv2.INTER_AREA)
+    else:
+        # A mídia é ampliada em pelo menos um eixo: parte do mesmo redimensionamento que 'exata' e reduz
+        # por área, em vez de um INTER_LINEAR que sub-amostra (com aliasing) o eixo que encolhe
+        bg_fill = cv2.resize(frame, (frame_width, frame_height), dst=buffers['redimensionado'] if buffers else None, interpolation=cv2.INTER_LINEAR)
+        reduzido = cv2.resize(bg_fill, pequeno, interpolation=cv2.INTER_AREA)
+    sigma_reduzido = np.sqrt(max(sigma * sigma - 0.25 * fator * fator, 0.25)) / fator
+    # 'exata' espelha no centro do pixel da borda (REFLECT_101); a 1/fator esse centro fica fator/2 pixels para
+    # dentro do frame, por isso aqui espelha-se na aresta do pixel (REFLECT), que coincide com a borda do frame
+    reduzido = cv2.GaussianBlur(reduzido, (0, 0), sigma_reduzido, borderType=cv2.BORDER_REFLECT)
+    return cv2.resize(reduzido, (frame_width, frame_height), dst=buffers['fundo'] if buffers else None, interpolation=cv2.INTER_LINEAR)
+
+def camada_fundo(ctx, params, entradas):
     # Camada 1: Fundo Desfocado
-    bg_fill = cv2.resize(frame_fundo_bgr_original, (frame_width, frame_height), interpolation=cv2.INTER_LINEAR)
     raw_blur = params.get('blurFundo', 25)
     blur_amount = max(1, int(raw_blur))
     if blur_amount % 2 == 0: blur_amount += 1
-    canvas = cv2.GaussianBlur(bg_fill, (blur_amount, blur_amount), 0)
+    qualidade = params.get('qualidadeBlur', 'exata')
+    if ctx['fonte'] and not ctx['buffers']:
+        # Frame fixo (imagem ou primeiro frame de um vídeo): o fundo desfocado fica em cache para esse ficheiro
+        chave = (tuple(ctx['final_dimensions']), blur_amount, qualidade)
+        return asset_cache.obter('fundo_desfocado', ctx['fonte'], chave, lambda: desfocar_fundo(ctx['frame_fundo'], ctx['final_dimensions'], blur_amount, qualidade))
+    return desfocar_fundo(ctx['frame_fundo'], ctx['final_dimensions'], blur_amount, qualidade, ctx['buffers'])
 
-    # Camada 2: Mídia Principal
+def camada_frente(ctx, params, entradas):
+    # Camada 2: Mídia Principal, redimensionada e com a máscara de borda (ainda sem posição)
+    frame_fundo_bgr_original = ctx['frame_fundo']
     escala_fundo = params.get('escalaFundo', 1.0)
     h_orig, w_orig, _ = frame_fundo_bgr_original.shape
     w_scaled, h_scaled = int(w_orig * escala_fundo), int(h_orig * escala_fundo)
-    if w_scaled > 0 and h_scaled > 0:
-        scaled_fg = cv2.resize(frame_fundo_bgr_original, (w_scaled, h_scaled), interpolation=cv2.INTER_AREA)
-        
-        # Garante que a mídia principal tenha 4 canais (BGRA)
-        if scaled_fg.shape[2] == 3:
-            scaled_fg_rgba = cv2.cvtColor(scaled_fg, cv2.COLOR_BGR2BGRA)
-        else:
-            scaled_fg_rgba = scaled_fg
-
-        # --- LÓGICA DE MÁSCARA DE BORDA ATUALIZADA ---
-        intensidade_mascara = params.get('intensidadeMascara', 0.0)
-        # A máscara só é criada se a intensidade for maior que zero
-        if intensidade_mascara > 0:
-            rotacao = params.get('rotacaoMascara', 0.0)
-            # O slider de posição Y não é usado aqui, apenas o X
-            posicao = params.get('posXMascara', 0) 
-            
-            edge_mask = create_edge_fade_mask(w_scaled, h_scaled, rotacao, posicao, intensidade_mascara)
-            
-            b, g, r, a = cv2.split(scaled_fg_rgba)
-            # A nova máscara é mesclada com o canal alfa existente
-            # (útil se a imagem original já tiver transparência)
-            new_alpha = cv2.min(a, edge_mask)
-            scaled_fg_rgba = cv2.merge([b, g, r, new_alpha])
-
-        # Sobrepõe a mídia principal (agora com borda suave) no canvas
-        offset_x = params.get('posXFundo', 0); offset_y = params.get('posYFundo', 0)
-        pos_x = int((frame_width - w_scaled) / 2) + offset_x
-        pos_y = int((frame_height - h_scaled) / 2) + offset_y
-        canvas = overlay_image(canvas, scaled_fg_rgba, pos_x, pos_y, 1.0)
-
-    # Camada 3: Efeito de Vinheta (Fade) - CÓDIGO CORRIGIDO
-    if img_fade.shape[:2] != (frame_height, frame_width):
-        img_fade = cv2.resize(img_fade, (frame_width, frame_height), interpolation=cv2.INTER_AREA)
-
-    # Separa os canais da imagem de fade (BGRA)
-    fade_bgr = img_fade[:, :, :3]
-    fade_alpha = img_fade[:, :, 3]
-
-    # Normaliza as imagens para o intervalo [0, 1] para a multiplicação
-    canvas_float = canvas.astype(np.float32) / 255.0
-    fade_bgr_float = fade_bgr.astype(np.float32) / 255.0
-    fade_alpha_float = fade_alpha.astype(np.float32) / 255.0
-    
-    # Cria uma máscara de alfa com 3 canais para a mesclagem
-    alpha_mask = cv2.merge([fade_alpha_float, fade_alpha_float, fade_alpha_float])
+    if w_scaled <= 0 or h_scaled <= 0: return None
 
-    # Executa a multiplicação (modo de mesclagem "multiply")
-    multiplied_layer = canvas_float * fade_bgr_float
-    
-    # Mescla a camada multiplicada com a original usando o alfa da vinheta
-    # Fórmula: (foreground * alpha) + (background * (1 - alpha))
-    blended_float = (multiplied_layer * alpha_mask) + (canvas_float * (1.0 - alpha_mask))
+    scaled_fg = cv2.resize(frame_fundo_bgr_original, (w_scaled, h_scaled), interpolation=cv2.INTER_AREA)
     
-    # Converte de volta para 8-bit (0-255)
-    imagem_com_fade = (blended_float * 255.0).astype(np.uint8)
+    # Garante que a mídia principal tenha 4 canais (BGRA)
+    if scaled_fg.shape[2] == 3:
+        scaled_fg_rgba = cv2.cvtColor(scaled_fg, cv2.COLOR_BGR2BGRA)
+    else:
+        scaled_fg_rgba = scaled_fg
 
+    # --- LÓGICA DE MÁSCARA DE BORDA ATUALIZADA ---
+    intensidade_mascara = params.get('intensidadeMascara', 0.0)
+    # A máscara só é criada se a intensidade for maior que zero
+    if intensidade_mascara > 0:
+        rotacao = params.get('rotacaoMascara', 0.0)
+        # O slider de posição Y não é usado aqui, apenas o X
+        posicao = params.get('posXMascara', 0) 
+        
+        edge_mask = mascara_borda(w_scaled, h_scaled, rotacao, posicao, intensidade_mascara)
+        
+        # A nova máscara é mesclada com o canal alfa existente, no próprio lugar
+        # (útil se a imagem original já tiver transparência)
+        np.minimum(scaled_fg_rgba[:, :, 3], edge_mask, out=scaled_fg_rgba[:, :, 3])
+    return scaled_fg_rgba
 
+def camada_composicao(ctx, params, entradas):
+    # Sobrepõe a mídia principal (agora com borda suave) no canvas
+    canvas = entradas['fundo'] if ctx['buffers'] else entradas['fundo'].copy()
+    scaled_fg_rgba = entradas['frente']
+    if scaled_fg_rgba is None: return canvas
+    frame_width, frame_height = ctx['final_dimensions']
+    h_scaled, w_scaled = scaled_fg_rgba.shape[:2]
+    offset_x = params.get('posXFundo', 0); offset_y = params.get('posYFundo', 0)
+    pos_x = int((frame_width - w_scaled) / 2) + offset_x
+    pos_y = int((frame_height - h_scaled) / 2) + offset_y
+    return overlay_image(canvas, scaled_fg_rgba, pos_x, pos_y, 1.0, ctx['buffers'])
+
+def camada_fade(ctx, params, entradas):
+    # Camada 3: Efeito de Vinheta (Fade), em modo "multiply" ponderado pelo alfa da vinheta.
+    # O fade é convertido uma vez num fator por pixel (ver preparar_fade).
+    canvas, buffers = entradas['composicao'], ctx['buffers']
+    fator = preparar_fade(ctx['img_fade'], ctx['final_dimensions'])
+    return multiplicar_fade(canvas, fator, buffers['fade'] if buffers else np.empty_like(canvas), buffers)
+
+def camada_logo(ctx, params, entradas):
     # Camada 4: Logo Urbnews
-    if img_logo is not None:
-        imagem_com_fade = overlay_image(imagem_com_fade, img_logo, params.get('posXLogo', 0), params.get('posYLogo', 0), params.get('escalaLogo', 1.0))
-    
-    pil_img = Image.fromarray(cv2.cvtColor(imagem_com_fade, cv2.COLOR_BGR2RGB))
-    draw = ImageDraw.Draw(pil_img)
-    font_retranca = ImageFont.truetype(params['fontPath'], int(40 * params.get('escalaRetranca', 1.0)))
-    font_titulo = ImageFont.truetype(params['fontPath'], params.get('fontSizeTitulo', 85))
+    if ctx['img_logo'] is None: return entradas['fade']
+    base = entradas['fade'] if ctx['buffers'] else entradas['fade'].copy()
+    return overlay_premultiplicado(base, ctx['img_logo'], params.get('posXLogo', 0), params.get('posYLogo', 0), params.get('escalaLogo', 1.0), ctx['buffers'], ctx['logo_path'])
+
+def renderizar_sprite_texto(params, final_dimensions, format_key):
+    # Camadas 5 a 7 desenhadas uma só vez numa imagem RGBA transparente, recortada à área com texto.
+    # Devolve (cor * alfa, 255 - alfa, x, y), pronto para compor_sprite, ou None se não houver nada visível.
+    frame_width, frame_height = final_dimensions
+    sprite = Image.new('RGBA', (frame_width, frame_height), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(sprite)
+    font_retranca = carregar_fonte(params['fontPath'], int(40 * params.get('escalaRetranca', 1.0)))
+    font_titulo = carregar_fonte(params['fontPath'], params.get('fontSizeTitulo', 85))
     
     # Camadas 5 e 6: Box da Tag e Texto da Tag
+    # Em renders a resolução reduzida (preview) as medidas fixas também são escaladas
+    escala_render = params.get('escalaRender', 1.0)
     padding_x = 25; padding_y = 12; ajustebox = 4
     if format_key == "800x600": padding_x = 12; padding_y = 5; ajustebox = 3
+    padding_x, padding_y, ajustebox = (int(round(v * escala_render)) for v in (padding_x, padding_y, ajustebox))
 
     if hasattr(draw, 'textbbox'):
         bbox = draw.textbbox((0, 0), params['retranca'], font=font_retranca)
@@ -230,30 +658,425 @@ def processar_frame(frame_fundo_bgr_original, img_logo, frame_identidade_bgr, im
     draw.text((text_x, text_y), params['retranca'], font=font_retranca, fill="#005291")
 
     # Camada 7: Texto do Título
-    max_width = frame_width - params.get('posXTitulo', 1000) - 50
-    linhas_titulo = wrap_text(params['titulo'], font_titulo, max_width, tracking=params.get('letterSpacingTitulo', 0))
+    # No preview as quebras de linha vêm já calculadas à resolução final (ver escalar_params)
+    linhas_titulo = params['linhasTitulo'] if 'linhasTitulo' in params else quebrar_titulo(params, frame_width)
     y_text = params.get('posYTitulo', 280)
+    line_height = altura_linha(font_titulo)
     for linha in linhas_titulo:
         draw_text_with_tracking(draw, (params.get('posXTitulo', 1000), y_text), linha, font_titulo, fill="white", tracking=params.get('letterSpacingTitulo', 0))
-        line_height = font_titulo.getbbox("A")[3] if hasattr(font_titulo, 'getbbox') else font_titulo.getsize("A")[1]
         y_text += line_height + params.get('lineSpacingTitulo', 4)
 
-    frame_com_texto = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-
-    # Camada 8: Identidade Visual Animada
-    if frame_identidade_bgr is not None:
-        if frame_identidade_bgr.shape[:2] != (frame_height, frame_width): frame_identidade_bgr = cv2.resize(frame_identidade_bgr, (frame_width, frame_height))
-        fade_start_time, fade_end_time = 3.0, 3.5
-        current_time = frame_count / fps
-        fade_opacity = 1.0
-        if current_time >= fade_end_time: fade_opacity = 0.0
-        elif current_time > fade_start_time: fade_opacity = 1.0 - ((current_time - fade_start_time) / (fade_end_time - fade_start_time))
-        return cv2.addWeighted(frame_identidade_bgr, fade_opacity, frame_com_texto, 1.0 - fade_opacity, 0)
-    return frame_com_texto
-
-# (O resto do arquivo continua igual, sem alterações)
-def render_video_for_format(format_key, assets, all_params):
+    bbox = sprite.getbbox()
+    if bbox is None: return None
+    x1, y1, x2, y2 = bbox
+    bgra = cv2.cvtColor(np.asarray(sprite.crop(bbox)), cv2.COLOR_RGBA2BGRA).astype(np.uint16)
+    alpha = bgra[:, :, 3:4]
+    return bgra[:, :, :3] * alpha, 255 - alpha, x1, y1
+
+# As fontes da cache são partilhadas e o FreeType não é thread-safe: o texto é desenhado uma thread de cada vez
+_texto_lock = threading.Lock()
+
+def carregar_sprite_texto(params, final_dimensions, format_key):
+    # O sprite só depende dos parâmetros de texto: num render é desenhado uma vez e reutilizado em todos os frames
+    chave = (tuple(final_dimensions), format_key) + tuple(_valor_para_chave(params.get(k)) for k in PARAMS_TEXTO)
+    def desenhar():
+        with _texto_lock: return renderizar_sprite_texto(params, final_dimensions, format_key)
+    return asset_cache.obter('sprite_texto', params['fontPath'], chave, desenhar)
+
+def compor_sprite(base, sprite, buffers=None):
+    # Com buffers escreve no próprio 'base'; sem eles devolve uma cópia
+    if sprite is None: return base
+    cor_alfa, alfa_inv, x, y = sprite
+    h, w = alfa_inv.shape[:2]
+    out = base if buffers else base.copy()
+    # Arredonda (em vez de truncar) como o PIL ao desenhar texto diretamente sobre a imagem
+    mesclar_premultiplicado(out[y:y + h, x:x + w], cor_alfa, alfa_inv, buffers, arredondar=True)
+    return out
+
+def camada_texto(ctx, params, entradas):
+    return compor_sprite(entradas['logo'], carregar_sprite_texto(params, ctx['final_dimensions'], ctx['format_key']), ctx['buffers'])
+
+# Parâmetros lidos pelas camadas de texto (5 a 7)
+PARAMS_TEXTO = ('fontPath', 'escalaRender', 'retranca', 'escalaRetranca', 'posXRetranca', 'posYRetranca', 'titulo', 'linhasTitulo',
+                'fontSizeTitulo', 'letterSpacingTitulo', 'lineSpacingTitulo', 'posXTitulo', 'posYTitulo')
+
+# (nome, camadas de que depende, parâmetros que lê, função), por ordem de avaliação
+CAMADAS = [
+    ('fundo', (), ('blurFundo', 'qualidadeBlur'), camada_fundo),
+    ('frente', (), ('escalaFundo', 'intensidadeMascara', 'rotacaoMascara', 'posXMascara'), camada_frente),
+    ('composicao', ('fundo', 'frente'), ('posXFundo', 'posYFundo'), camada_composicao),
+    ('fade', ('composicao',), (), camada_fade),
+    ('logo', ('fade',), ('posXLogo', 'posYLogo', 'escalaLogo'), camada_logo),
+    ('texto', ('logo',), PARAMS_TEXTO, camada_texto),
+]
+
+def _valor_para_chave(valor):
+    return tuple(valor) if isinstance(valor, list) else valor
+
+def avaliar_camadas(ctx, params, memo=None):
+    saidas, chaves = {}, {}
+    for nome, deps, keys, fn in CAMADAS:
+        chave = (ctx['chave'], tuple(_valor_para_chave(params.get(k)) for k in keys), tuple(chaves[d] for d in deps))
+        chaves[nome] = chave
+        if memo is not None and nome in memo and memo[nome][0] == chave:
+            saidas[nome] = memo[nome][1]
+            continue
+        inicio = time.perf_counter()
+        saidas[nome] = fn(ctx, params, {d: saidas[d] for d in deps})
+        if ctx['tempos'] is not None: ctx['tempos'].registar(nome, time.perf_counter() - inicio)
+        if memo is not None:
+            # A saída fica partilhada entre pedidos: as camadas seguintes copiam antes de alterar
+            if isinstance(saidas[nome], np.ndarray): saidas[nome].setflags(write=False)
+            memo[nome] = (chave, saidas[nome])
+    return saidas[CAMADAS[-1][0]]
+
+# Memos de camadas por sessão de edição (preview); as sessões menos recentes são descartadas
+PREVIEW_SESSOES_MAX = 8
+preview_sessions = OrderedDict()
+preview_sessions_lock = threading.Lock()
+
+def memo_da_sessao(session_id):
+    with preview_sessions_lock:
+        memo = preview_sessions.pop(session_id, None)
+        if memo is None: memo = {}
+        preview_sessions[session_id] = memo
+        while len(preview_sessions) > PREVIEW_SESSOES_MAX: preview_sessions.popitem(last=False)
+    return memo
+
+def compor_camadas_estaticas(frame_fundo_bgr_original, img_logo, img_fade, params, final_dimensions, format_key, memo=None, chave_contexto=None, buffers=None, media_path=None, tempos=None, logo_path=None):
+    # Camadas 1 a 7: tudo o que não depende do número do frame.
+    # Com memo, chave_contexto tem de identificar a mídia, o fade e o logo usados.
+    # media_path: ficheiro de onde vem um frame fixo (imagem/primeiro frame), para guardar o fundo desfocado em cache.
+    # Com buffers (criar_buffers), o frame devolvido é um desses buffers e só é válido até ao frame seguinte.
+    # tempos: Cronometro opcional onde fica o tempo de cada camada calculada.
+    # logo_path: ficheiro de onde veio img_logo, para guardar o logo redimensionado na cache de assets.
+    if memo is not None and buffers is not None: raise ValueError("memo e buffers não podem ser usados em conjunto")
+    ctx = {'frame_fundo': frame_fundo_bgr_original, 'img_logo': img_logo, 'img_fade': img_fade, 'buffers': buffers, 'fonte': media_path, 'tempos': tempos, 'logo_path': logo_path,
+           'final_dimensions': tuple(final_dimensions), 'format_key': format_key, 'chave': (chave_contexto, tuple(final_dimensions), format_key)}
+    return avaliar_camadas(ctx, params, memo)
+
+def quebrar_titulo(params, frame_width):
+    font_titulo = carregar_fonte(params['fontPath'], params.get('fontSizeTitulo', 85))
+    max_width = frame_width - params.get('posXTitulo', 1000) - 50
+    return wrap_text(params['titulo'], font_titulo, max_width, tracking=params.get('letterSpacingTitulo', 0))
+
+def escalar_params(params, final_dimensions, escala):
+    # Adapta os parâmetros de um formato para renderizar a uma fração do tamanho de saída,
+    # de forma a que a imagem reduzida corresponda ao render final.
+    if escala == 1.0: return params, final_dimensions
+    scaled = dict(params)
+    for key, default in PARAMS_EM_PIXELS.items():
+        if key in params or default is not None: scaled[key] = params.get(key, default) * escala
+    for key, default in PARAMS_DE_ESCALA.items():
+        scaled[key] = params.get(key, default) * escala
+    scaled['fontSizeTitulo'] = max(1, int(round(scaled['fontSizeTitulo'])))
+    scaled['blurFundo'] = max(1, int(round(params.get('blurFundo', 25) * escala)))
+    scaled['escalaRender'] = escala
+    frame_width, frame_height = final_dimensions
+    # Com métricas de fonte reduzidas os arredondamentos mudam as quebras de linha; usa as do tamanho final
+    with _texto_lock: scaled['linhasTitulo'] = quebrar_titulo(params, frame_width)
+    return scaled, (max(1, int(round(frame_width * escala))), max(1, int(round(frame_height * escala))))
+
+def processar_frame(frame_fundo_bgr_original, img_logo, frame_identidade_bgr, img_fade, frame_count, fps, params, final_dimensions, format_key, buffers=None, logo_path=None):
+    frame_com_texto = compor_camadas_estaticas(frame_fundo_bgr_original, img_logo, img_fade, params, final_dimensions, format_key, buffers=buffers, logo_path=logo_path)
+    return aplicar_identidade(frame_com_texto, frame_identidade_bgr, frame_count, fps, final_dimensions, out=buffers['final'] if buffers else None)
+
+# --- Leitura de Mídia ---
+
+class LeitorSequencial:
+    # Lê um vídeo uma única vez, do início ao fim, através do iterador do imageio.
+    # frame(i) devolve o frame (BGR) a mostrar no frame i da saída: converte o tempo
+    # pelo fps de origem e, quando o clipe acaba, mantém o último frame decodificado.
+    # Os índices pedidos têm de ser crescentes.
+    def __init__(self, path, fps_saida):
+        self.path = path
+        self.reader = imageio.get_reader(path)
+        self.fps_origem = float(self.reader.get_meta_data().get('fps') or fps_saida)
+        self.fps_saida = fps_saida
+        self._frames = self.reader.iter_data()
+        self._indice, self._rgb, self._bgr = -1, None, None
+        self._esgotado = False
+
+    def frame(self, i):
+        alvo = int(i * self.fps_origem / self.fps_saida + 0.5)
+        while self._indice < alvo and not self._esgotado:
+            try: rgb = next(self._frames)
+            except StopIteration: self._esgotado = True; break
+            self._indice += 1
+            self._rgb, self._bgr = rgb, None
+        if self._rgb is None: raise ValueError(f"Nenhum frame encontrado em {os.path.basename(self.path)}")
+        if self._bgr is None: self._bgr = cv2.cvtColor(self._rgb, cv2.COLOR_RGB2BGR)
+        return self._bgr
+
+    def close(self):
+        self.reader.close()
+
+def frames_identidade(id_video_path, final_dimensions, fps):
+    # Array (n, altura, largura, 3) só de leitura, com os n primeiros frames da saída, os únicos em que a
+    # identidade tem opacidade > 0. O nome do ficheiro inclui o hash do webm: se o webm mudar, é gerado outro.
+    frame_width, frame_height = final_dimensions
+    prefixo = f"{os.path.splitext(os.path.basename(id_video_path))[0]}_{frame_width}x{frame_height}_{fps}fps_"
+    path = os.path.join(IDENTIDADE_CACHE_FOLDER, f"{prefixo}{hash_ficheiro(id_video_path)[:16]}.npy")
+    # O mtime marca o último uso, para limpar_cache_identidade apagar primeiro os menos usados
+    try: os.utime(path)
+    except FileNotFoundError:
+        gerar_frames_identidade(id_video_path, final_dimensions, fps, path, prefixo)
+        limpar_cache_identidade(manter=path)
+    # O inode distingue um ficheiro apagado pela limpeza e gerado de novo do memory-map antigo
+    return abrir_frames_identidade(path, os.stat(path).st_ino)
+
+@functools.lru_cache(maxsize=16)
+def abrir_frames_identidade(path, inode):
+    return np.load(path, mmap_mode='r')
+
+def gerar_frames_identidade(id_video_path, final_dimensions, fps, path, prefixo):
+    frame_width, frame_height = final_dimensions
+    visiveis = 0
+    while calcular_opacidade_identidade(visiveis, fps) > 0.0: visiveis += 1
+    os.makedirs(IDENTIDADE_CACHE_FOLDER, exist_ok=True)
+    # Escreve num ficheiro temporário e só no fim o põe no lugar, para outro processo nunca abrir um ficheiro a meio
+    temporario = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+    leitor = LeitorSequencial(id_video_path, fps)
+    try:
+        frames = np.lib.format.open_memmap(temporario, mode='w+', dtype=np.uint8, shape=(visiveis, frame_height, frame_width, 3))
+        for i in range(visiveis):
+            bgr = leitor.frame(i)
+            frames[i] = bgr if bgr.shape[:2] == (frame_height, frame_width) else cv2.resize(bgr, (frame_width, frame_height))
+        frames.flush()
+        del frames
+        os.replace(temporario, path)
+    except Exception:
+        if os.path.exists(temporario): os.remove(temporario)
+        raise
+    finally:
+        leitor.close()
+    # Versões geradas a partir de um webm anterior
+    for nome in os.listdir(IDENTIDADE_CACHE_FOLDER):
+        antigo = os.path.join(IDENTIDADE_CACHE_FOLDER, nome)
+        if nome.startswith(prefixo) and nome.endswith('.npy') and antigo != path:
+            try: os.remove(antigo)
+            except OSError: pass
+
+def limpar_cache_identidade(manter=None):
+    # Apaga os .npy usados há mais tempo até a pasta caber em IDENTIDADE_CACHE_MB. Um render que ainda tenha
+    # o ficheiro em memory-map continua a lê-lo; o próximo que precisar dele volta a gerá-lo.
+    if not os.path.isdir(IDENTIDADE_CACHE_FOLDER): return
+    entradas = []
+    for nome in os.listdir(IDENTIDADE_CACHE_FOLDER):
+        path = os.path.join(IDENTIDADE_CACHE_FOLDER, nome)
+        if not nome.endswith('.npy'): continue
+        try: stat = os.stat(path)
+        except OSError: continue
+        entradas.append((stat.st_mtime, stat.st_size, path))
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, path in sorted(entradas):
+        if total <= IDENTIDADE_CACHE_MB * 1024 * 1024: break
+        if path == manter: continue
+        try: os.remove(path)
+        except OSError: continue
+        total -= tamanho
+
+# --- Pipeline de Render ---
+# Decodificação, composição e escrita correm em threads diferentes, ligadas por filas limitadas:
+# uma thread de prefetch por vídeo de origem, um pool de composição que processa frames fora de
+# ordem e a thread que chama executar_pipeline, que escreve os frames pela ordem certa.
+
+class PipelineParado(Exception):
+    pass
+
+def _colocar(fila, item, parar):
+    while not parar.is_set():
+        try: fila.put(item, timeout=0.1); return
+        except queue.Full: pass
+    raise PipelineParado()
+
+def _retirar(fila, parar):
+    while not parar.is_set():
+        try: return fila.get(timeout=0.1)
+        except queue.Empty: pass
+    raise PipelineParado()
+
+class Prefetch:
+    # Lê de um LeitorSequencial, numa thread própria, os frames de 'indices' (crescentes),
+    # até PREFETCH_FRAMES à frente de quem os consome. frame() tem de seguir a mesma ordem.
+    # Com tempos (Cronometro), o tempo de decodificação de cada frame fica na etapa 'etapa'.
+    def __init__(self, leitor, indices, parar, tempos=None, etapa='decode'):
+        self.leitor, self.parar, self.tempos, self.etapa = leitor, parar, tempos, etapa
+        self.fila = queue.Queue(PREFETCH_FRAMES)
+        self.thread = threading.Thread(target=self._decodificar, args=(indices,), daemon=True)
+        self.thread.start()
+
+    def _decodificar(self, indices):
+        try:
+            for i in indices:
+                inicio = time.perf_counter()
+                frame = self.leitor.frame(i)
+                if self.tempos is not None: self.tempos.registar(self.etapa, time.perf_counter() - inicio)
+                _colocar(self.fila, (i, frame), self.parar)
+        except PipelineParado: pass
+        except Exception as e:
+            try: _colocar(self.fila, (None, e), self.parar)
+            except PipelineParado: pass
+
+    def frame(self, i):
+        indice, frame = _retirar(self.fila, self.parar)
+        if indice is None: raise frame
+        return frame
+
+def executar_pipeline(total_frames, fontes, compor, escrever, criar_saida, threads=None, em_voo=None, tempos=None):
+    # fontes: {nome: (leitor, indices)}; compor(i, frames, saida) recebe {nome: frame ou None} e um frame de
+    # saída livre, corre no pool e devolve o frame final ('saida' ou um frame fixo). escrever(frame, i) corre
+    # nesta thread, pela ordem dos frames. Só há 'em_voo' frames de saída: quando acabam, a decodificação e a
+    # composição esperam pelo encoder. Uma exceção em qualquer etapa para o pipeline e é relançada aqui.
+    # tempos: Cronometro opcional para os tempos de decodificação (etapa 'decode_<nome>').
+    threads, em_voo = threads or COMPOSITOR_THREADS, em_voo or FRAMES_EM_VOO
+    parar = threading.Event()
+    livres, pendentes = queue.Queue(), queue.Queue()
+    for _ in range(em_voo): livres.put(criar_saida())
+    prefetch = {nome: (Prefetch(leitor, indices, parar, tempos, f'decode_{nome}'), set(indices)) for nome, (leitor, indices) in fontes.items()}
+    pool = ThreadPoolExecutor(max_workers=threads)
+
+    def tarefa(i, frames, saida):
+        return compor(i, frames, saida), saida
+
+    def alimentar():
+        try:
+            for i in range(total_frames):
+                saida = _retirar(livres, parar)
+                frames = {nome: leitor.frame(i) if i in indices else None for nome, (leitor, indices) in prefetch.items()}
+                pendentes.put(pool.submit(tarefa, i, frames, saida))
+        except PipelineParado: pass
+        except Exception as e:
+            falha = Future()
+            falha.set_exception(e)
+            pendentes.put(falha)
+
+    alimentador = threading.Thread(target=alimentar, daemon=True)
+    alimentador.start()
+    try:
+        for i in range(total_frames):
+            frame, saida = pendentes.get().result()
+            escrever(frame, i)
+            livres.put(saida)
+    finally:
+        parar.set()
+        alimentador.join()
+        pool.shutdown(wait=True, cancel_futures=True)
+        for leitor, _ in prefetch.values(): leitor.thread.join()
+
+# --- Codificação de Vídeo ---
+
+class EncoderOpenCV:
+    def __init__(self, path, fps, dims, opcoes):
+        self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*opcoes['fourcc']), fps, tuple(dims))
+        if not self.writer.isOpened(): raise RuntimeError(f"Não foi possível abrir {os.path.basename(path)} para escrita")
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+    def abortar(self):
+        self.writer.release()
+
+class EncoderFFmpeg:
+    # Envia os frames BGR em bruto para o stdin do ffmpeg, que codifica noutro processo em paralelo
+    # com a composição. write() passa o próprio array ao pipe (sem cópias) e só regressa depois de o
+    # ffmpeg o ter lido, por isso o chamador pode reutilizar o buffer logo a seguir.
+    def __init__(self, path, fps, dims, opcoes):
+        width, height = dims
+        self.path, self.tamanho_frame = path, width * height * 3
+        cmd = [imageio_ffmpeg.get_ffmpeg_exe(), '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+               '-an', '-c:v', opcoes['codec'], '-pix_fmt', opcoes['pixFmt'], '-threads', str(int(opcoes['threads']))]
+        if opcoes.get('preset'): cmd += ['-preset', str(opcoes['preset'])]
+        if opcoes.get('bitrate'): cmd += ['-b:v', str(opcoes['bitrate'])]
+        elif opcoes.get('crf') is not None: cmd += ['-crf', str(opcoes['crf'])]
+        # yuv420p exige dimensões pares
+        if width % 2 or height % 2: cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        cmd += ['-movflags', '+faststart', path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        if frame.nbytes != self.tamanho_frame: raise ValueError(f"Frame com tamanho inesperado para {os.path.basename(self.path)}")
+        try: self.proc.stdin.write(frame if frame.flags.c_contiguous else np.ascontiguousarray(frame))
+        except BrokenPipeError: self._terminar()
+
+    def _terminar(self):
+        if self.proc.stdin and not self.proc.stdin.closed: self.proc.stdin.close()
+        erro = self.proc.stderr.read().decode(errors='replace').strip()
+        if self.proc.wait() != 0: raise RuntimeError(f"ffmpeg falhou ao codificar {os.path.basename(self.path)}: {erro or self.proc.returncode}")
+
+    def release(self):
+        if self.proc.returncode is None: self._terminar()
+
+    def abortar(self):
+        if self.proc.returncode is None: self.proc.kill(); self.proc.wait()
+
+ENCODERS = {'ffmpeg': EncoderFFmpeg, 'opencv': EncoderOpenCV}
+
+def opcoes_encoder(all_params, format_key):
+    return {**ENCODER_PADRAO, **(all_params.get('encoder') or {}), **(all_params['formats'][format_key].get('encoder') or {})}
+
+def criar_encoder(path, fps, dims, opcoes):
+    if opcoes['backend'] not in ENCODERS: raise ValueError(f"Backend de codificação desconhecido: {opcoes['backend']}")
+    return ENCODERS[opcoes['backend']](path, fps, dims, opcoes)
+
+# --- Progresso e Cancelamento ---
+
+class RenderCancelado(Exception):
+    pass
+
+class ProgressoRender:
+    # Estado partilhado entre o job e os processos que renderizam: 'estado' guarda, por label,
+    # o frame atual, o total e o estado do formato; 'cancelamento' é um Event.
+    # Com vários processos, ambos são proxies de um multiprocessing.Manager.
+    def __init__(self, estado, cancelamento):
+        self.estado = estado
+        self.cancelamento = cancelamento
+
+    def atualizar(self, label, frame, total, status):
+        self.estado[label] = {"frame": frame, "totalFrames": total, "status": status}
+
+    def avancar(self, label, frame, total):
+        if frame % PROGRESSO_INTERVALO and frame != total: return
+        if self.cancelamento.is_set(): raise RenderCancelado("Renderização cancelada.")
+        self.atualizar(label, frame, total, "rendering")
+
+    def cancelado(self):
+        return self.cancelamento.is_set()
+
+_manager = None
+
+def criar_progresso(workers):
+    global _manager
+    if workers == 1: return ProgressoRender({}, threading.Event())
+    if _manager is None: _manager = MP_CONTEXTO.Manager()
+    return ProgressoRender(_manager.dict(), _manager.Event())
+
+def url_saida(path):
+    # URL servida por /output/ para um ficheiro dentro de OUTPUT_FOLDER (ou numa subpasta)
+    return "/output/" + os.path.relpath(path, OUTPUT_FOLDER).replace(os.sep, '/')
+
+def nome_ficheiro_saida(params, label):
+    date_str = datetime.now().strftime("%d%m%Y")
+    retranca_str = re.sub(r'[^a-zA-Z0-9_]', '', params.get('retranca', 'RETRANCA')).upper()
+    return f"{date_str}_{label}_URBNEWS_{retranca_str}.mp4"
+
+def render_video_for_format(format_key, assets, all_params, derived_outputs=None, progress=None, output_folder=None):
+    # derived_outputs: lista de saídas extra (label, dimensões, duração em segundos) escritas na mesma passagem.
+    # Cada frame composto é redimensionado para cada saída; se a saída for mais longa do que o vídeo base,
+    # o último frame é repetido até ao fim, sem voltar a decodificar nada.
+    # progress: ProgressoRender opcional, atualizado durante o loop de frames (e que o pode cancelar).
+    # output_folder: pasta onde os vídeos são escritos (por omissão, OUTPUT_FOLDER).
+    derived_outputs = derived_outputs or []
+    output_folder = output_folder or OUTPUT_FOLDER
+    tempos, inicio_render = Cronometro(), time.perf_counter()
+    open_writers, open_paths = [], []
+    user_media_source = None
     try:
+        if progress and progress.cancelado(): raise RenderCancelado("Renderização cancelada.")
         format_params = all_params['formats'][format_key]
         params = {**all_params, **format_params}
         fps = int(params.get('framerate', 30))
@@ -266,48 +1089,308 @@ def render_video_for_format(format_key, assets, all_params):
         logo_img_path = os.path.join(ASSETS_FOLDER, "logo_urbnews.png")
         font_path = os.path.join(ASSETS_FOLDER, 'Figtree-Bold.ttf')
         params['fontPath'] = font_path
+        params.setdefault('qualidadeBlur', BLUR_QUALIDADE_RENDER)
 
         if not all(os.path.exists(p) for p in [id_video_path, fade_img_path, logo_img_path, font_path]):
             raise FileNotFoundError(f"Assets não encontrados para {assets['label']}")
 
-        id_video_reader = imageio.get_reader(id_video_path)
-        img_fade = cv2.imread(fade_img_path, cv2.IMREAD_UNCHANGED)
-        img_logo = cv2.imread(logo_img_path, cv2.IMREAD_UNCHANGED)
+        identidade = frames_identidade(id_video_path, final_dimensions, fps)
+        img_fade = carregar_fade(fade_img_path, final_dimensions)
+        img_logo = carregar_imagem(logo_img_path)
         
         user_media_path = os.path.join(BASE_DIR, params.get('userMediaFilename'))
-        is_user_media_video = '.' in user_media_path and user_media_path.rsplit('.', 1)[1].lower() in ['mp4', 'webm', 'mov']
-        user_media_reader = imageio.get_reader(user_media_path) if is_user_media_video else None
-        user_img_bgr = cv2.imread(user_media_path) if not is_user_media_video else None
-
-        date_str = datetime.now().strftime("%d%m%Y")
-        retranca_str = re.sub(r'[^a-zA-Z0-9_]', '', params.get('retranca', 'RETRANCA')).upper()
-        output_filename = f"{date_str}_{assets['label']}_URBNEWS_{retranca_str}.mp4"
-        output_path = os.path.join(OUTPUT_FOLDER, output_filename)
+        is_user_media_video = is_video_file(user_media_path)
+        user_media_source = LeitorSequencial(user_media_path, fps) if is_user_media_video else None
+        user_img_bgr = carregar_imagem(user_media_path, cv2.IMREAD_COLOR) if not is_user_media_video else None
+
+        output_filename = nome_ficheiro_saida(params, assets['label'])
+        output_path = os.path.join(output_folder, output_filename)
         
-        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, final_dimensions)
+        encoder = opcoes_encoder(all_params, format_key)
+        writer = criar_encoder(output_path, fps, final_dimensions, encoder)
+        open_writers.append(writer); open_paths.append(output_path)
+
+        sinks = []
+        for label, dims, duration in derived_outputs:
+            filename = nome_ficheiro_saida(params, label)
+            sinks.append({"label": label, "filename": filename, "path": os.path.join(output_folder, filename), "dims": tuple(dims),
+                          "frames": int(duration * fps), "writer": criar_encoder(os.path.join(output_folder, filename), fps, dims, encoder),
+                          "origem": None, "redimensionado": np.empty((dims[1], dims[0], 3), np.uint8)})
+            open_writers.append(sinks[-1]["writer"]); open_paths.append(sinks[-1]["path"])
+
+        def escrever(frame, i):
+            if progress: progress.avancar(assets['label'], i + 1, total_frames)
+            inicio = time.perf_counter()
+            writer.write(frame)
+            inicio_derivados = time.perf_counter()
+            tempos.registar('encode', inicio_derivados - inicio)
+            for sink in sinks:
+                if i >= sink["frames"]: continue
+                # O frame estático em cache não muda: só é redimensionado uma vez
+                if frame is not frame_estatico or sink["origem"] is not frame_estatico:
+                    cv2.resize(frame, sink["dims"], dst=sink["redimensionado"], interpolation=cv2.INTER_AREA)
+                    sink["origem"] = frame
+                sink["writer"].write(sink["redimensionado"])
+            if sinks: tempos.registar('derivados', time.perf_counter() - inicio_derivados)
         
-        for i in range(total_frames):
-            try: id_rgb = id_video_reader.get_data(i)
-            except IndexError: id_rgb = id_video_reader.get_data(id_video_reader.count_frames() - 1)
-            id_bgr = cv2.cvtColor(id_rgb, cv2.COLOR_RGB2BGR)
-
-            if is_user_media_video:
-                try: user_rgb = user_media_reader.get_data(i)
-                except IndexError: user_rgb = user_media_reader.get_data(user_media_reader.count_frames() - 1)
-                frame_fundo = cv2.cvtColor(user_rgb, cv2.COLOR_RGB2BGR)
-            else: frame_fundo = user_img_bgr
-
-            final_frame = processar_frame(frame_fundo, img_logo, id_bgr, img_fade, i, fps, params, final_dimensions, format_key)
-            writer.write(final_frame)
+        # Com imagem estática, as camadas 1 a 7 são iguais em todos os frames: compõe uma vez só
+        frame_estatico = None if is_user_media_video else compor_camadas_estaticas(user_img_bgr, img_logo, img_fade, params, final_dimensions, format_key, media_path=user_media_path, tempos=tempos, logo_path=logo_img_path)
+        locais = threading.local()
+
+        def compor(i, frames, saida):
+            # Depois do fade a identidade já não é visível e a camada 8 não é aplicada
+            id_bgr = identidade[i] if i < len(identidade) else None
+            if frame_estatico is not None:
+                if id_bgr is None: return frame_estatico
+                inicio = time.perf_counter()
+                final_frame = aplicar_identidade(frame_estatico, id_bgr, i, fps, final_dimensions, out=saida)
+                tempos.registar('identidade', time.perf_counter() - inicio)
+                return final_frame
+            # Cada thread de composição tem os seus buffers
+            if not hasattr(locais, 'buffers'): locais.buffers = criar_buffers(final_dimensions)
+            frame_com_texto = compor_camadas_estaticas(frames['fundo'], img_logo, img_fade, params, final_dimensions, format_key, buffers=locais.buffers, tempos=tempos, logo_path=logo_img_path)
+            inicio = time.perf_counter()
+            final_frame = aplicar_identidade(frame_com_texto, id_bgr, i, fps, final_dimensions, out=saida)
+            if final_frame is not saida: np.copyto(saida, final_frame)
+            tempos.registar('identidade' if id_bgr is not None else 'copia', time.perf_counter() - inicio)
+            return saida
+
+        fontes = {'fundo': (user_media_source, range(total_frames))} if is_user_media_video else {}
+        executar_pipeline(total_frames, fontes, compor, escrever, lambda: np.empty((final_dimensions[1], final_dimensions[0], 3), np.uint8), tempos=tempos)
+
+        # Saídas mais longas do que o vídeo base (ex.: TER, 15 s) repetem o último frame
+        inicio = time.perf_counter()
+        for sink in sinks:
+            for _ in range(total_frames, sink["frames"]):
+                if sink["origem"] is not None: sink["writer"].write(sink["redimensionado"])
+            sink["writer"].release()
         
         writer.release()
-        id_video_reader.close()
-        if user_media_reader: user_media_reader.close()
+        # Inclui o tempo que o encoder leva a esvaziar o que ainda tinha em fila
+        tempos.registar('finalizar', time.perf_counter() - inicio)
         
-        return {"url": f"/output/{output_filename}", "label": assets['label'], "path": output_path, "base_format": assets['label']}
+        if progress: progress.atualizar(assets['label'], total_frames, total_frames, "done")
+        # 'amostras' alimenta /metrics e o resumo do job e é retirado por separar_timings; 'timings' segue na resposta
+        segundos = time.perf_counter() - inicio_render
+        derived_results = [{"url": url_saida(sink["path"]), "label": sink["label"], "path": sink["path"]} for sink in sinks]
+        return {"url": url_saida(output_path), "label": assets['label'], "path": output_path, "base_format": assets['label'], "derived": derived_results,
+                "timings": resumir_tempos(tempos.amostras, total_frames, segundos), "amostras": (tempos.amostras, total_frames, segundos)}
+    except Exception as e:
+        for open_writer in open_writers: open_writer.abortar()
+        cancelled = isinstance(e, RenderCancelado)
+        if cancelled:
+            # Não deixa ficheiros incompletos em output/
+            for path in open_paths:
+                if os.path.exists(path): os.remove(path)
+        else: print(f"[ERRO] ao renderizar {assets.get('label', 'formato desconhecido')}: {e}")
+        if progress: progress.atualizar(assets.get('label', 'formato desconhecido'), 0, 0, "cancelled" if cancelled else "error")
+        return {"error": str(e), "label": assets.get('label', 'formato desconhecido'), "derived": [{"error": str(e), "label": label} for label, _, _ in derived_outputs]}
+    finally:
+        # O decoder da mídia (ffmpeg) é fechado também em erro ou cancelamento
+        if user_media_source: user_media_source.close()
+
+# --- Cache de Renders ---
+# Cada formato (base + derivados) fica numa pasta cache/renders/<chave>, com um <label>.mp4 por saída.
+# A chave é o hash dos parâmetros efetivos do formato e do conteúdo da mídia e dos assets que usa.
+
+_hashes_ficheiros = {}
+render_cache_lock = threading.Lock()
+
+def hash_ficheiro(path):
+    # sha256 do conteúdo, recalculado só quando o ficheiro muda
+    stat = os.stat(path)
+    chave = (path, stat.st_mtime_ns, stat.st_size)
+    if chave not in _hashes_ficheiros:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for bloco in iter(lambda: f.read(1 << 20), b''): h.update(bloco)
+        _hashes_ficheiros[chave] = h.hexdigest()
+    return _hashes_ficheiros[chave]
+
+def chave_render(format_key, assets, all_params, derived_outputs):
+    # None quando não é possível calcular a chave (ex.: mídia em falta); o render trata do erro
+    try:
+        params = {k: v for k, v in {**all_params, **all_params['formats'][format_key]}.items() if k not in PARAMS_FORA_DA_CACHE}
+        params.setdefault('qualidadeBlur', BLUR_QUALIDADE_RENDER)
+        params['encoder'] = opcoes_encoder(all_params, format_key)
+        ficheiros = [os.path.join(BASE_DIR, params.get('userMediaFilename'))]
+        ficheiros += [os.path.join(ASSETS_FOLDER, nome) for nome in (assets['base'], assets['fade'], 'logo_urbnews.png', 'Figtree-Bold.ttf')]
+        conteudo = {'versao': RENDER_CACHE_VERSAO, 'formato': format_key, 'label': assets['label'], 'params': params,
+                    'derivados': [[label, list(dims), duration] for label, dims, duration in derived_outputs],
+                    'ficheiros': [hash_ficheiro(path) for path in ficheiros]}
+        return hashlib.sha256(json.dumps(conteudo, sort_keys=True, default=str).encode()).hexdigest()[:32]
+    except Exception:
+        return None
+
+def obter_render_em_cache(chave, format_key, assets, all_params, derived_outputs, output_folder=None):
+    # Copia as saídas guardadas para output_folder com o nome de hoje e devolve o mesmo dicionário que
+    # render_video_for_format, ou None se a chave não estiver (completa) na cache.
+    output_folder = output_folder or OUTPUT_FOLDER
+    pasta = os.path.join(RENDER_CACHE_FOLDER, chave)
+    params = {**all_params, **all_params['formats'][format_key]}
+    saidas = []
+    with render_cache_lock:
+        if not os.path.isdir(pasta): return None
+        labels = [assets['label']] + [label for label, _, _ in derived_outputs]
+        if not all(os.path.exists(os.path.join(pasta, f"{label}.mp4")) for label in labels): return None
+        os.utime(pasta)
+        for label in labels:
+            filename = nome_ficheiro_saida(params, label)
+            # Cópia e não hard link: um render posterior reescreve o ficheiro de output/ no próprio lugar
+            path = os.path.join(output_folder, filename)
+            shutil.copyfile(os.path.join(pasta, f"{label}.mp4"), path)
+            saidas.append({"url": url_saida(path), "label": label, "path": path, "cache": True})
+    return {**saidas[0], "base_format": assets['label'], "derived": saidas[1:]}
+
+def guardar_render_em_cache(chave, result):
+    if "error" in result or any("error" in derived for derived in result["derived"]): return
+    temporaria = os.path.join(RENDER_CACHE_FOLDER, f".{chave}.{uuid.uuid4().hex[:8]}")
+    os.makedirs(temporaria)
+    for saida in [result] + result["derived"]:
+        shutil.copyfile(saida["path"], os.path.join(temporaria, f"{saida['label']}.mp4"))
+    with render_cache_lock:
+        pasta = os.path.join(RENDER_CACHE_FOLDER, chave)
+        if os.path.isdir(pasta): shutil.rmtree(temporaria, ignore_errors=True)
+        else: os.rename(temporaria, pasta)
+        limpar_render_cache()
+
+def limpar_render_cache():
+    # Apaga as entradas sem uso há mais de RENDER_CACHE_DIAS e depois as menos usadas até caber em RENDER_CACHE_MB
+    if not os.path.isdir(RENDER_CACHE_FOLDER): return
+    agora, entradas = time.time(), []
+    for nome in os.listdir(RENDER_CACHE_FOLDER):
+        pasta = os.path.join(RENDER_CACHE_FOLDER, nome)
+        if not os.path.isdir(pasta): continue
+        usado = os.path.getmtime(pasta)
+        if agora - usado > RENDER_CACHE_DIAS * 86400: shutil.rmtree(pasta, ignore_errors=True)
+        # Pastas temporárias de outros renders ainda a ser copiadas
+        elif not nome.startswith('.'): entradas.append((usado, sum(os.path.getsize(os.path.join(pasta, f)) for f in os.listdir(pasta)), pasta))
+    total = sum(tamanho for _, tamanho, _ in entradas)
+    for _, tamanho, pasta in sorted(entradas):
+        if total <= RENDER_CACHE_MB * 1024 * 1024: break
+        shutil.rmtree(pasta, ignore_errors=True)
+        total -= tamanho
+
+# --- Agendamento dos Formatos ---
+
+def render_all_formats(settings, workers=None, progress=None, usar_cache=None, pool=None, output_folder=None):
+    # Renderiza os formatos base em paralelo; os derivados saem na mesma passagem do respetivo formato base.
+    # Os formatos que não mudaram desde um render anterior vêm da cache de renders (com "cache": True).
+    # pool: ProcessPoolExecutor já aberto (ex.: partilhado por um lote inteiro, criado com mp_context=MP_CONTEXTO);
+    # sem ele é criado um com 'workers'.
+    # Devolve (base_results, derived_results) na ordem de FORMAT_ASSETS / DERIVED_FORMATS. Os formatos renderizados
+    # trazem 'timings' e 'amostras', que separar_timings tira antes de os devolver numa resposta.
+    workers = RENDER_WORKERS if workers is None else max(1, workers)
+    usar_cache = RENDER_CACHE_MB > 0 if usar_cache is None else usar_cache
+    format_keys = list(FORMAT_ASSETS)
+    tasks = [(key, FORMAT_ASSETS[key], settings, DERIVED_FORMATS.get(FORMAT_ASSETS[key]['label'], []), progress, output_folder) for key in format_keys]
+    chaves = [chave_render(*task[:4]) if usar_cache else None for task in tasks]
+    results = [None] * len(tasks)
+
+    for n, (task, chave) in enumerate(zip(tasks, chaves)):
+        if not chave: continue
+        try: results[n] = obter_render_em_cache(chave, *task[:4], output_folder)
+        except Exception as e: print(f"[AVISO] Cache de renders indisponível para {task[1]['label']}: {e}")
+        if results[n] and progress:
+            total_frames = 10 * int(settings.get('framerate', 30))
+            progress.atualizar(task[1]['label'], total_frames, total_frames, "cached")
+    a_renderizar = [n for n in range(len(tasks)) if results[n] is None]
+
+    def renderizar_no_pool(pool):
+        futures = [(n, pool.submit(render_video_for_format, *tasks[n])) for n in a_renderizar]
+        for n, future in futures:
+            try: results[n] = future.result()
+            except Exception as e:
+                assets, derived_outputs = tasks[n][1], tasks[n][3]
+                print(f"[ERRO] ao renderizar {assets['label']}: {e}")
+                results[n] = {"error": str(e), "label": assets['label'], "derived": [{"error": str(e), "label": label} for label, _, _ in derived_outputs]}
+
+    if pool is not None:
+        renderizar_no_pool(pool)
+    elif workers == 1:
+        for n in a_renderizar: results[n] = render_video_for_format(*tasks[n])
+    elif a_renderizar:
+        with ProcessPoolExecutor(max_workers=min(workers, len(a_renderizar)), mp_context=MP_CONTEXTO) as pool:
+            renderizar_no_pool(pool)
+
+    for n in range(len(tasks)):
+        label = tasks[n][1]['label']
+        if n not in a_renderizar: metricas.registar_render(label, "cache")
+        elif "error" in results[n]: metricas.registar_render(label, "error")
+        else: metricas.registar_render(label, "ok", *results[n]["amostras"])
+
+    for n in a_renderizar:
+        if "error" not in results[n]:
+            results[n]["cache"] = False
+            for derived in results[n]["derived"]: derived.setdefault("cache", False)
+        if not chaves[n]: continue
+        try: guardar_render_em_cache(chaves[n], results[n])
+        except Exception as e: print(f"[AVISO] Não foi possível guardar {tasks[n][1]['label']} na cache de renders: {e}")
+
+    derived_results = [derived for result in results for derived in result.pop("derived", [])]
+    return results, derived_results
+
+def criar_zip(generated_files):
+    if not generated_files: return None
+    date_str = datetime.now().strftime("%d%m%Y_%H%M")
+    zip_filename = f"Urbnews_Videos_{date_str}.zip"
+    zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
+    with zipfile.ZipFile(zip_path, 'w') as zipf:
+        for file_path in generated_files:
+            zipf.write(file_path, os.path.basename(file_path))
+    return f"/output/{zip_filename}"
+
+# --- Fila de Jobs de Renderização ---
+
+render_jobs = {}
+render_jobs_lock = threading.Lock()
+job_executor = ThreadPoolExecutor(max_workers=RENDER_JOB_SLOTS)
+
+def submeter_job(settings):
+    job_id = uuid.uuid4().hex[:12]
+    fps = int(settings.get('framerate', 30))
+    progress = criar_progresso(RENDER_WORKERS)
+    for assets in FORMAT_ASSETS.values(): progress.atualizar(assets['label'], 0, 10 * fps, "queued")
+    job = {"id": job_id, "status": "queued", "created": time.time(), "finished": None, "progress": progress, "result": None, "error": None}
+    with render_jobs_lock:
+        terminados = sorted((j for j in render_jobs.values() if j["finished"]), key=lambda j: j["finished"])
+        for antigo in terminados[:max(0, len(terminados) - MAX_JOBS_GUARDADOS + 1)]: del render_jobs[antigo["id"]]
+        render_jobs[job_id] = job
+        job["future"] = job_executor.submit(executar_job, job, settings)
+    return job_id
+
+def executar_job(job, settings):
+    progress = job["progress"]
+    if progress.cancelado():
+        job["status"], job["finished"] = "cancelled", time.time()
+        return
+    job["status"] = "running"
+    try:
+        inicio = time.perf_counter()
+        base_results, derived_results = render_all_formats(settings, progress=progress)
+        if progress.cancelado():
+            job["status"] = "cancelled"
+        else:
+            segundos = time.perf_counter() - inicio
+            metricas.registar_job(*juntar_amostras(base_results), segundos)
+            timings = separar_timings(base_results, segundos)
+            all_results = base_results + derived_results
+            zip_url = criar_zip([res["path"] for res in all_results if "path" in res])
+            job["result"] = {"downloadUrls": all_results, "zipUrl": zip_url, "cacheHits": [res["label"] for res in all_results if res.get("cache")], "timings": timings}
+            job["status"] = "done"
     except Exception as e:
-        print(f"[ERRO] ao renderizar {assets.get('label', 'formato desconhecido')}: {e}")
-        return {"error": str(e), "label": assets.get('label', 'formato desconhecido')}
+        print(f"[ERRO] Job {job['id']}: {e}")
+        job["status"], job["error"] = "error", str(e)
+    job["finished"] = time.time()
+
+def estado_job(job):
+    formats = dict(job["progress"].estado)
+    total = sum(f["totalFrames"] for f in formats.values() if f["status"] not in ("error", "cancelled"))
+    feitos = sum(f["frame"] for f in formats.values() if f["status"] not in ("error", "cancelled"))
+    estado = {"jobId": job["id"], "status": job["status"], "formats": formats, "progress": (feitos / total) if total else 0.0}
+    if job["result"]: estado.update(job["result"])
+    if job["error"]: estado["error"] = job["error"]
+    return estado
 
 # --- Servidor Flask ---
 
@@ -331,49 +1414,53 @@ def upload_media():
 
 @app.route('/preview-frame', methods=['POST'])
 def preview_frame_endpoint():
-    with preview_lock:
-        try:
-            params = {k: (float(v) if v.replace('.', '', 1).replace('-', '', 1).isdigit() else v) for k, v in request.form.items()}
-            format_key = params.get('format', '1920x1080')
-            if format_key not in FORMAT_ASSETS: return jsonify({'error': 'Formato inválido'}), 400
-            
-            assets = FORMAT_ASSETS[format_key]
-            final_dimensions = tuple(map(int, format_key.split('x')))
-            fps = int(params.get('framerate', 30))
-            
-            settings = json.load(open(SETTINGS_FILE_PATH)) if os.path.exists(SETTINGS_FILE_PATH) else {}
-            user_media_path = os.path.join(BASE_DIR, settings.get('userMediaFilename'))
-            if not os.path.exists(user_media_path): return jsonify({'error': 'Ficheiro de mídia não encontrado.'}), 400
-
-            font_path = os.path.join(ASSETS_FOLDER, 'Figtree-Bold.ttf')
-            logo_img_path = os.path.join(ASSETS_FOLDER, "logo_urbnews.png")
-            fade_img_path = os.path.join(ASSETS_FOLDER, assets['fade'])
-            
-            params.update(settings)
-            format_specific_settings = settings.get('formats', {}).get(format_key, {})
-            combined_params = {**format_specific_settings, **params}
-            combined_params['fontPath'] = font_path
-
-            img_logo = cv2.imread(logo_img_path, cv2.IMREAD_UNCHANGED)
-            img_fade = cv2.imread(fade_img_path, cv2.IMREAD_UNCHANGED)
-
-            is_video = '.' in user_media_path and user_media_path.rsplit('.', 1)[1].lower() in ['mp4', 'webm', 'mov']
-            if is_video:
-                reader = imageio.get_reader(user_media_path)
-                frame_fundo = cv2.cvtColor(reader.get_data(0), cv2.COLOR_RGB2BGR)
-                reader.close()
-            else:
-                frame_fundo = cv2.imread(user_media_path)
-
-            final_frame = processar_frame(frame_fundo, img_logo, None, img_fade, 5 * fps, fps, combined_params, final_dimensions, format_key)
-            
-            cv2.imwrite(PREVIEW_FILE_PATH, final_frame)
-            return jsonify({'previewUrl': '/static/preview.jpg'})
-        except Exception as e:
-            import traceback
-            traceback.print_exc()
-            print(f"[ERRO] Preview: {e}")
-            return jsonify({'error': str(e)}), 500
+    # Renderiza um frame (sem identidade animada) a resolução reduzida e devolve o JPEG diretamente,
+    # sem ficheiros partilhados nem lock global: vários editores podem pedir previews em simultâneo.
+    try:
+        params = {k: (float(v) if v.replace('.', '', 1).replace('-', '', 1).isdigit() else v) for k, v in request.form.items()}
+        format_key = params.get('format', '1920x1080')
+        if format_key not in FORMAT_ASSETS: return jsonify({'error': 'Formato inválido'}), 400
+        
+        assets = FORMAT_ASSETS[format_key]
+        final_dimensions = tuple(map(int, format_key.split('x')))
+        escala = min(1.0, max(0.1, float(params.get('previewScale', PREVIEW_SCALE))))
+        
+        settings = carregar_settings()
+        user_media_path = os.path.join(BASE_DIR, settings.get('userMediaFilename'))
+        if not os.path.exists(user_media_path): return jsonify({'error': 'Ficheiro de mídia não encontrado.'}), 400
+
+        font_path = os.path.join(ASSETS_FOLDER, 'Figtree-Bold.ttf')
+        logo_img_path = os.path.join(ASSETS_FOLDER, "logo_urbnews.png")
+        fade_img_path = os.path.join(ASSETS_FOLDER, assets['fade'])
+        
+        params.update(settings)
+        format_specific_settings = settings.get('formats', {}).get(format_key, {})
+        combined_params = {**format_specific_settings, **params}
+        combined_params['fontPath'] = font_path
+        combined_params.setdefault('qualidadeBlur', BLUR_QUALIDADE_PREVIEW)
+        combined_params, preview_dimensions = escalar_params(combined_params, final_dimensions, escala)
+
+        img_logo = carregar_imagem(logo_img_path)
+        img_fade = carregar_fade(fade_img_path, preview_dimensions)
+        frame_fundo = carregar_primeiro_frame(user_media_path)
+
+        # O preview não mostra a identidade animada: só as camadas estáticas, memorizadas por sessão de edição
+        session_id = request.form.get('previewSession')
+        memo = memo_da_sessao(session_id) if session_id else None
+        chave_contexto = tuple((path, os.path.getmtime(path)) for path in (user_media_path, fade_img_path, logo_img_path))
+        tempos, inicio = Cronometro(), time.perf_counter()
+        final_frame = compor_camadas_estaticas(frame_fundo, img_logo, img_fade, combined_params, preview_dimensions, format_key, memo=memo, chave_contexto=chave_contexto, media_path=user_media_path, tempos=tempos, logo_path=logo_img_path)
+        
+        ok, jpeg = cv2.imencode('.jpg', final_frame, [cv2.IMWRITE_JPEG_QUALITY, PREVIEW_JPEG_QUALITY])
+        if not ok: raise RuntimeError("Falha ao codificar o preview em JPEG.")
+        tempos.registar('total', time.perf_counter() - inicio)
+        metricas.registar_amostras(assets['label'], {f"preview_{etapa}": valores for etapa, valores in tempos.amostras.items()})
+        return Response(jpeg.tobytes(), mimetype='image/jpeg', headers={'Cache-Control': 'no-store'})
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        print(f"[ERRO] Preview: {e}")
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/generate-video', methods=['POST'])
 def generate_video_endpoint():
@@ -381,75 +1468,41 @@ def generate_video_endpoint():
         if not os.path.exists(SETTINGS_FILE_PATH): return jsonify({'error': "Ficheiro 'settings.json' não encontrado."}), 400
         with open(SETTINGS_FILE_PATH, 'r') as f: settings = json.load(f)
         
-        base_results = [render_video_for_format(key, assets, settings) for key, assets in FORMAT_ASSETS.items()]
-        
-        generated_files = [res["path"] for res in base_results if "path" in res]
-        derived_results = []
-
-        for result in base_results:
-            if "path" not in result: continue
-
-            base_format_label = result.get("base_format")
-            if not base_format_label: continue
-            
-            source_path = result["path"]
-            
-            derived_map = {
-                "WIDEFULLHD": [("WIDE", (1280, 720), 10), ("TER", (1280, 720), 15)],
-                "MUB-FOR-SP": [("LED4", (864, 288), 10)],
-                "VERTFULLHD": [("VERT", (608, 1080), 10)]
-            }
-
-            if base_format_label in derived_map:
-                for label, dims, duration in derived_map[base_format_label]:
-                    try:
-                        new_filename = os.path.basename(source_path).replace(base_format_label, label)
-                        new_path = os.path.join(OUTPUT_FOLDER, new_filename)
-                        
-                        reader = cv2.VideoCapture(source_path)
-                        fps = int(reader.get(cv2.CAP_PROP_FPS))
-                        writer = cv2.VideoWriter(new_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, dims)
-                        
-                        total_frames = duration * fps
-                        source_frame_count = int(reader.get(cv2.CAP_PROP_FRAME_COUNT))
-                        last_frame = None
-
-                        for i in range(total_frames):
-                            if i < source_frame_count:
-                                ret, frame = reader.read()
-                                if not ret: break
-                                last_frame = frame
-                            
-                            if last_frame is None: continue
-                            resized_frame = cv2.resize(last_frame, dims, interpolation=cv2.INTER_AREA)
-                            writer.write(resized_frame)
-
-                        reader.release()
-                        writer.release()
-                        derived_results.append({"url": f"/output/{new_filename}", "label": label, "path": new_path})
-                    except Exception as e:
-                        print(f"[ERRO] ao gerar formato derivado {label}: {e}")
-                        derived_results.append({"error": str(e), "label": label})
-        
-        all_results = base_results + derived_results
-        generated_files.extend([res["path"] for res in derived_results if "path" in res])
-
-        zip_url = None
-        if generated_files:
-            date_str = datetime.now().strftime("%d%m%Y_%H%M")
-            zip_filename = f"Urbnews_Videos_{date_str}.zip"
-            zip_path = os.path.join(OUTPUT_FOLDER, zip_filename)
-            with zipfile.ZipFile(zip_path, 'w') as zipf:
-                for file_path in generated_files:
-                    zipf.write(file_path, os.path.basename(file_path))
-            zip_url = f"/output/{zip_filename}"
-
-        return jsonify({"downloadUrls": all_results, "zipUrl": zip_url})
+        # Pedido síncrono, mas na mesma fila dos jobs: respeita RENDER_JOB_SLOTS e aparece em /render-jobs
+        job = render_jobs[submeter_job(settings)]
+        job["future"].result()
+        if job["status"] == "error": return jsonify({'error': job["error"], 'jobId': job["id"]}), 500
+        if job["status"] == "cancelled": return jsonify({'error': 'Renderização cancelada.', 'jobId': job["id"]}), 409
+        return jsonify({**job["result"], 'jobId': job["id"]})
 
     except Exception as e:
         print(f"[ERRO] Geração de vídeo: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/render-jobs', methods=['POST'])
+def submit_render_job():
+    if not os.path.exists(SETTINGS_FILE_PATH): return jsonify({'error': "Ficheiro 'settings.json' não encontrado."}), 400
+    with open(SETTINGS_FILE_PATH, 'r') as f: settings = json.load(f)
+    job_id = submeter_job(settings)
+    return jsonify({'jobId': job_id, 'statusUrl': f"/render-jobs/{job_id}"}), 202
+
+@app.route('/render-jobs/<job_id>', methods=['GET'])
+def render_job_status(job_id):
+    job = render_jobs.get(job_id)
+    if job is None: return jsonify({'error': 'Job não encontrado.'}), 404
+    return jsonify(estado_job(job))
+
+@app.route('/render-jobs/<job_id>/cancel', methods=['POST'])
+def cancel_render_job(job_id):
+    job = render_jobs.get(job_id)
+    if job is None: return jsonify({'error': 'Job não encontrado.'}), 404
+    if job["status"] in ("queued", "running"): job["progress"].cancelamento.set()
+    return jsonify(estado_job(job))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metricas.prometheus(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/load-settings', methods=['GET'])
 def load_settings():
     if not os.path.exists(SETTINGS_FILE_PATH): return jsonify({}), 200
@@ -460,7 +1513,7 @@ def save_settings():
     with open(SETTINGS_FILE_PATH, 'w') as f: json.dump(request.json, f, indent=4)
     return jsonify({'status': 'success'})
 
-@app.route('/output/<filename>')
+@app.route('/output/<path:filename>')
 def get_output_file(filename):
     return send_from_directory(OUTPUT_FOLDER, filename, as_attachment=True)
 
@@ -469,7 +1522,7 @@ def get_asset_file(filename):
     return send_from_directory(ASSETS_FOLDER, filename)
 
 if __name__ == '__main__':
-    for folder in [ASSETS_FOLDER, STATIC_FOLDER, TEMPLATES_FOLDER, UPLOAD_FOLDER, OUTPUT_FOLDER]:
+    for folder in [ASSETS_FOLDER, STATIC_FOLDER, TEMPLATES_FOLDER, UPLOAD_FOLDER, OUTPUT_FOLDER, RENDER_CACHE_FOLDER, IDENTIDADE_CACHE_FOLDER]:
         os.makedirs(folder, exist_ok=True)
     app.run(debug=True, port=5000)
 
@@ -0,0 +1,105 @@
+# Renderização em lote, sem passar pelo servidor Flask:
+#   python batch.py noticias.jsonl [--settings settings.json] [--saida pasta] [--workers N] [--sem-cache]
+#
+# Cada linha do manifesto (JSONL) é uma notícia, por exemplo:
+#   {"id": "transito", "media": "fotos/transito.jpg", "titulo": "...", "retranca": "SEGURANÇA VIÁRIA",
+#    "framerate": 30, "formats": {"800x600": {"posXLogo": 520}}}
+# "media" é obrigatório (caminho relativo ao manifesto ou absoluto); "formats" altera os parâmetros de cada
+# formato do settings.json base; as restantes chaves (titulo, retranca, framerate, encoder...) substituem as
+# de topo. Cada notícia é escrita numa pasta própria dentro de --saida.
+
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import app
+
+def ler_manifesto(path):
+    pasta = os.path.dirname(os.path.abspath(path))
+    noticias = []
+    with open(path, encoding='utf-8') as f:
+        for numero, linha in enumerate(f, 1):
+            if not linha.strip(): continue
+            try: noticia = json.loads(linha)
+            except json.JSONDecodeError as e: raise ValueError(f"Linha {numero} do manifesto não é JSON válido: {e}")
+            if not noticia.get('media'): raise ValueError(f"Linha {numero} do manifesto sem 'media'")
+            noticia['media'] = os.path.join(pasta, noticia['media'])
+            if not os.path.exists(noticia['media']): raise ValueError(f"Linha {numero}: mídia não encontrada ({noticia['media']})")
+            desconhecidos = set(noticia.get('formats', {})) - set(app.FORMAT_ASSETS)
+            if desconhecidos: raise ValueError(f"Linha {numero}: formatos desconhecidos {sorted(desconhecidos)}")
+            noticia.setdefault('id', f"{numero:03d}_{re.sub(r'[^a-zA-Z0-9_]', '', noticia.get('retranca', 'NOTICIA')).upper()}")
+            noticias.append(noticia)
+    return noticias
+
+def settings_da_noticia(base, noticia):
+    settings = copy.deepcopy(base)
+    settings.update({k: v for k, v in noticia.items() if k not in ('id', 'media', 'formats')})
+    settings['userMediaFilename'] = noticia['media']
+    formats = settings.setdefault('formats', {})
+    for format_key in app.FORMAT_ASSETS:
+        # A mídia pode estar guardada por formato no settings.json: a da notícia tem prioridade
+        formats[format_key] = {**formats.get(format_key, {}), **noticia.get('formats', {}).get(format_key, {}), 'userMediaFilename': noticia['media']}
+    return settings
+
+def preparar_assets(lista_settings):
+    # Corre no processo principal antes de abrir o pool, para os frames da identidade ficarem gerados uma
+    # só vez, e depois como initializer de cada processo do pool: os processos não são criados por fork
+    # (ver app.MP_CONTEXTO), por isso cada um aquece a sua cache de assets e abre os .npy já gerados.
+    app.carregar_imagem(os.path.join(app.ASSETS_FOLDER, "logo_urbnews.png"))
+    for format_key, assets in app.FORMAT_ASSETS.items():
+        final_dimensions = tuple(map(int, format_key.split('x')))
+        app.carregar_fade(os.path.join(app.ASSETS_FOLDER, assets['fade']), final_dimensions)
+        for fps in sorted({int({**settings, **settings['formats'][format_key]}.get('framerate', 30)) for settings in lista_settings}):
+            app.frames_identidade(os.path.join(app.ASSETS_FOLDER, assets['base']), final_dimensions, fps)
+
+def renderizar_noticia(noticia, settings, pasta, pool, workers, usar_cache):
+    os.makedirs(pasta, exist_ok=True)
+    inicio = time.time()
+    base_results, derived_results = app.render_all_formats(settings, workers=workers, usar_cache=usar_cache, pool=pool, output_folder=pasta)
+    timings = app.separar_timings(base_results, time.time() - inicio)
+    all_results = base_results + derived_results
+    return {"id": noticia['id'], "pasta": pasta, "segundos": timings["segundos"], "fps": {label: resumo["fps"] for label, resumo in timings["formats"].items()},
+            "ficheiros": [res["path"] for res in all_results if "path" in res],
+            "cacheHits": [res["label"] for res in all_results if res.get("cache")],
+            "erros": {res["label"]: res["error"] for res in all_results if "error" in res}}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Renderiza em lote as notícias de um manifesto JSONL.")
+    parser.add_argument('manifesto')
+    parser.add_argument('--settings', default=app.SETTINGS_FILE_PATH, help="settings.json com os parâmetros base de cada formato")
+    parser.add_argument('--saida', default=None, help="pasta onde é criada uma subpasta por notícia (por omissão, output/lote_<data>)")
+    parser.add_argument('--workers', type=int, default=app.RENDER_WORKERS, help="processos de renderização partilhados pelo lote")
+    parser.add_argument('--sem-cache', action='store_true', help="renderiza tudo, sem usar a cache de renders")
+    args = parser.parse_args(argv)
+
+    with open(args.settings, encoding='utf-8') as f: base = json.load(f)
+    noticias = ler_manifesto(args.manifesto)
+    saida = args.saida or os.path.join(app.OUTPUT_FOLDER, f"lote_{datetime.now().strftime('%d%m%Y_%H%M%S')}")
+    lista_settings = [settings_da_noticia(base, noticia) for noticia in noticias]
+    preparar_assets(lista_settings)
+
+    workers = max(1, args.workers)
+    falhas = 0
+    # Um único pool de processos para o lote inteiro; cada notícia é acompanhada por uma thread que
+    # consulta a cache de renders e submete ao pool os formatos que faltam.
+    pool = ProcessPoolExecutor(max_workers=workers, mp_context=app.MP_CONTEXTO, initializer=preparar_assets, initargs=(lista_settings,)) if workers > 1 else None
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as noticias_em_curso:
+            futures = [noticias_em_curso.submit(renderizar_noticia, noticia, settings, os.path.join(saida, re.sub(r'[^\w-]', '_', str(noticia['id']))), pool, workers, not args.sem_cache)
+                       for noticia, settings in zip(noticias, lista_settings)]
+            for future in futures:
+                resultado = future.result()
+                falhas += bool(resultado["erros"])
+                print(json.dumps(resultado, ensure_ascii=False), flush=True)
+    finally:
+        if pool: pool.shutdown()
+    return 1 if falhas else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
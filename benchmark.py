@@ -0,0 +1,324 @@
+# Benchmark do motor de renderização, offline e com mídia sintética (gerada com semente fixa):
+#   python benchmark.py                         # mede e grava output/benchmark/resultado_<data>.json
+#   python benchmark.py --gravar-baseline       # grava também o resultado como baseline.json
+#   python benchmark.py --gravar-referencia     # grava os frames de referência para o teste de pixels
+#   python benchmark.py --limite 0.15 --sem-render --formatos 800x600 1920x1080
+#
+# Mede, para cada formato de FORMAT_ASSETS (e cada tamanho derivado), frames/s das funções do compositor
+# e do render completo (imagem e vídeo), com tempo total e pico de RSS de cada render (num processo próprio).
+# Com um baseline.json, falha (exit 1) se algum fps cair mais do que --limite. Com uma referência gravada,
+# compara os frames compostos pixel a pixel e falha se algum canal diferir mais do que --tolerancia-pixels.
+# Verifica também cada qualidade de blur contra 'exata' em todos os tamanhos de FORMAT_ASSETS, com as imagens
+# sintéticas, e falha se o erro passar de app.BLUR_LIMITES_ERRO (a mídia do editor é medida só a título informativo).
+# Fluxo típico: gravar baseline e referência no commit anterior, aplicar a alteração e voltar a correr.
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+from datetime import datetime
+
+import cv2
+import imageio
+import numpy as np
+
+import app
+
+BENCH_FOLDER = os.path.join(app.OUTPUT_FOLDER, 'benchmark')
+LOGO_PATH = os.path.join(app.ASSETS_FOLDER, "logo_urbnews.png")
+SEMENTE = 20250903
+# Frames compostos no teste de pixels: antes, durante e depois do fade da identidade
+FRAMES_PIXELS = (0, 95, 100, 150)
+# Tamanhos de kernel do teste das qualidades de blur (cobrem os fatores de redução 1, 2, 4 e 8)
+BLUR_KERNELS = (25, 35, 45, 59, 75, 101, 151)
+TITULO = "Benchmark do compositor com um título longo o suficiente para quebrar em várias linhas"
+RETRANCA = "BENCHMARK"
+
+# --- Mídia Sintética ---
+
+def gerar_imagem(path, rng, w=1600, h=1200, ruido=12):
+    # Gradiente com ruído e formas: detalhe suficiente para o blur, a máscara e o JPEG trabalharem a sério
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    img = np.dstack([x / w * 255, y / h * 255, (x + y) / (w + h) * 255])
+    img += rng.normal(0, ruido, img.shape)
+    img = np.clip(img, 0, 255).astype(np.uint8)
+    for _ in range(40):
+        centro = (int(rng.integers(0, w)), int(rng.integers(0, h)))
+        cor = tuple(int(c) for c in rng.integers(0, 256, 3))
+        cv2.circle(img, centro, int(rng.integers(20, 200)), cor, -1, lineType=cv2.LINE_AA)
+    cv2.imwrite(path, img)
+
+def gerar_video(path, rng, segundos=4, fps=25):
+    base = np.clip(rng.normal(128, 40, (720, 1280, 3)), 0, 255).astype(np.uint8)
+    with imageio.get_writer(path, fps=fps, codec='libx264', quality=8, macro_block_size=16) as writer:
+        for i in range(segundos * fps):
+            frame = np.roll(base, i * 8, axis=1)
+            cv2.putText(frame, f"{i:03d}", (540, 400), cv2.FONT_HERSHEY_SIMPLEX, 5, (255, 255, 255), 10)
+            writer.append_data(frame)
+
+def preparar_media():
+    pasta = os.path.join(BENCH_FOLDER, 'media')
+    os.makedirs(pasta, exist_ok=True)
+    imagem, video = os.path.join(pasta, 'imagem.png'), os.path.join(pasta, 'video.mp4')
+    # Foto de paisagem pequena e com grão: nos formatos verticais é ampliada num eixo e reduzida no outro, o caso
+    # em que uma redução sem filtro antes do blur reduzido produz aliasing (teste das qualidades de blur)
+    paisagem = os.path.join(pasta, 'paisagem.png')
+    if not os.path.exists(imagem): gerar_imagem(imagem, np.random.default_rng(SEMENTE))
+    if not os.path.exists(video): gerar_video(video, np.random.default_rng(SEMENTE + 1))
+    if not os.path.exists(paisagem): gerar_imagem(paisagem, np.random.default_rng(SEMENTE + 2), 1320, 720, ruido=40)
+    return {'imagem': imagem, 'video': video, 'paisagem': paisagem}
+
+def settings_do_benchmark(media_path):
+    # Layout de cada formato vem do settings.json; texto e mídia são fixos para os resultados serem comparáveis
+    settings = app.carregar_settings()
+    settings.update({'titulo': TITULO, 'retranca': RETRANCA, 'framerate': 30, 'userMediaFilename': media_path})
+    for format_key in app.FORMAT_ASSETS:
+        settings.setdefault('formats', {}).setdefault(format_key, {})['userMediaFilename'] = media_path
+    return settings
+
+def params_do_formato(settings, format_key):
+    params = {**settings, **settings['formats'][format_key]}
+    params['fontPath'] = os.path.join(app.ASSETS_FOLDER, 'Figtree-Bold.ttf')
+    params.setdefault('qualidadeBlur', app.BLUR_QUALIDADE_RENDER)
+    return params
+
+def hash_params(params):
+    return hashlib.sha256(json.dumps({k: v for k, v in params.items() if k not in app.PARAMS_FORA_DA_CACHE}, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+# --- Medição ---
+
+def medir(fn, iteracoes, aquecimento=2):
+    for _ in range(aquecimento): fn()
+    tempos = []
+    for _ in range(iteracoes):
+        inicio = time.perf_counter()
+        fn()
+        tempos.append(time.perf_counter() - inicio)
+    p50, p95 = np.percentile(tempos, [50, 95])
+    return {"fps": round(1.0 / p50, 2) if p50 else None, "p50_ms": round(p50 * 1000, 3), "p95_ms": round(p95 * 1000, 3), "iteracoes": iteracoes}
+
+def pico_rss_mb():
+    # ru_maxrss vem em KB no Linux e em bytes no macOS
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def entradas_do_formato(settings, format_key, media):
+    assets = app.FORMAT_ASSETS[format_key]
+    final_dimensions = tuple(map(int, format_key.split('x')))
+    img_logo = app.carregar_imagem(LOGO_PATH)
+    img_fade = app.carregar_fade(os.path.join(app.ASSETS_FOLDER, assets['fade']), final_dimensions)
+    identidade = app.frames_identidade(os.path.join(app.ASSETS_FOLDER, assets['base']), final_dimensions, 30)
+    imagem = app.carregar_imagem(media['imagem'], cv2.IMREAD_COLOR)
+    return assets, final_dimensions, img_logo, img_fade, identidade, imagem
+
+def benchmark_funcoes(settings, format_key, media, iteracoes):
+    assets, final_dimensions, img_logo, img_fade, identidade, imagem = entradas_do_formato(settings, format_key, media)
+    params = params_do_formato(settings, format_key)
+    frame_width, frame_height = final_dimensions
+    buffers = app.criar_buffers(final_dimensions)
+    resultados = {}
+
+    resultados['processar_frame'] = medir(lambda: app.processar_frame(imagem, img_logo, identidade[0], img_fade, 0, 30, params, final_dimensions, format_key, buffers=buffers, logo_path=LOGO_PATH), iteracoes)
+    resultados['processar_frame_sem_identidade'] = medir(lambda: app.processar_frame(imagem, img_logo, None, img_fade, 150, 30, params, final_dimensions, format_key, buffers=buffers, logo_path=LOGO_PATH), iteracoes)
+    fundo = np.full((frame_height, frame_width, 3), 90, np.uint8)
+    resultados['overlay_image'] = medir(lambda: app.overlay_image(fundo, img_logo, int(params.get('posXLogo', 0)), int(params.get('posYLogo', 0)), params.get('escalaLogo', 1.0), buffers), iteracoes)
+    escala_fundo = params.get('escalaFundo', 1.0)
+    w_mask, h_mask = int(imagem.shape[1] * escala_fundo), int(imagem.shape[0] * escala_fundo)
+    resultados['create_edge_fade_mask'] = medir(lambda: app.create_edge_fade_mask(w_mask, h_mask, params.get('rotacaoMascara', 0), params.get('posXMascara', 0), params.get('intensidadeMascara', 0.1)), iteracoes)
+    fonte = app.carregar_fonte(params['fontPath'], params.get('fontSizeTitulo', 85))
+    largura = frame_width - params.get('posXTitulo', 1000) - 50
+    resultados['wrap_text'] = medir(lambda: app.wrap_text(TITULO, fonte, largura, tracking=params.get('letterSpacingTitulo', 0)), iteracoes * 10)
+    resultados['desfocar_fundo'] = medir(lambda: app.desfocar_fundo(imagem, final_dimensions, int(params.get('blurFundo', 25)) | 1, params['qualidadeBlur'], buffers), iteracoes)
+
+    # Saídas derivadas: o frame final é reduzido para cada uma na mesma passagem do render
+    final_frame = app.processar_frame(imagem, img_logo, None, img_fade, 150, 30, params, final_dimensions, format_key, logo_path=LOGO_PATH).copy()
+    for label, dims, _ in app.DERIVED_FORMATS.get(assets['label'], []):
+        destino = np.empty((dims[1], dims[0], 3), np.uint8)
+        resultados[f'derivado_{label}_{dims[0]}x{dims[1]}'] = medir(lambda: cv2.resize(final_frame, tuple(dims), dst=destino, interpolation=cv2.INTER_AREA), iteracoes)
+    return resultados
+
+def _render_isolado(format_key, settings, pasta):
+    # Corre num processo novo, para o pico de RSS ser só deste render
+    assets = app.FORMAT_ASSETS[format_key]
+    inicio = time.perf_counter()
+    res = app.render_video_for_format(format_key, assets, settings, app.DERIVED_FORMATS.get(assets['label'], []), output_folder=pasta)
+    segundos = time.perf_counter() - inicio
+    if "error" in res: return {"erro": res["error"]}
+    saidas = {}
+    for saida in [res] + res["derived"]:
+        captura = cv2.VideoCapture(saida["path"])
+        saidas[saida["label"]] = int(captura.get(cv2.CAP_PROP_FRAME_COUNT))
+        captura.release()
+    return {"fps": res["timings"]["fps"], "segundos": round(segundos, 3), "pico_rss_mb": pico_rss_mb(), "frames": saidas,
+            "etapas_p50_ms": {etapa: resumo["p50_ms"] for etapa, resumo in res["timings"]["etapas"].items()}}
+
+def benchmark_render(settings, format_key):
+    pasta = os.path.join(BENCH_FOLDER, 'videos')
+    os.makedirs(pasta, exist_ok=True)
+    # 'spawn' e não fork: um filho criado por fork herda o RSS do benchmark (cache de assets, buffers, imagens
+    # das funções já medidas) e o ru_maxrss dele começaria aí, em vez de medir só o render.
+    with multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(_render_isolado, (format_key, settings, pasta))
+
+def frames_para_pixels(settings, format_key, media):
+    # Frames compostos (e as respetivas saídas derivadas) usados no teste de pixels
+    assets, final_dimensions, img_logo, img_fade, identidade, imagem = entradas_do_formato(settings, format_key, media)
+    params = params_do_formato(settings, format_key)
+    leitor = app.LeitorSequencial(media['video'], 30)
+    frames = {}
+    try:
+        for i in FRAMES_PIXELS:
+            id_bgr = identidade[i] if i < len(identidade) else None
+            for nome, fundo in (('imagem', imagem), ('video', leitor.frame(i))):
+                final_frame = app.processar_frame(fundo, img_logo, id_bgr, img_fade, i, 30, params, final_dimensions, format_key, logo_path=LOGO_PATH).copy()
+                frames[f"{format_key}/{nome}/{i}"] = final_frame
+                for label, dims, _ in app.DERIVED_FORMATS.get(assets['label'], []):
+                    frames[f"{format_key}/{nome}/{i}/{label}"] = cv2.resize(final_frame, tuple(dims), interpolation=cv2.INTER_AREA)
+    finally:
+        leitor.close()
+    return frames
+
+def comparar_pixels(frames, referencia, tolerancia):
+    resultado = {}
+    for chave, frame in frames.items():
+        if chave not in referencia: continue
+        ref = referencia[chave]
+        if ref.shape != frame.shape:
+            resultado[chave] = {"ok": False, "erro": f"dimensões {frame.shape} != {ref.shape}"}
+            continue
+        diferenca = cv2.absdiff(frame, ref)
+        maximo = int(diferenca.max())
+        resultado[chave] = {"ok": maximo <= tolerancia, "max": maximo, "media": round(float(diferenca.mean()), 4),
+                            "pixels_diferentes": round(float(np.count_nonzero(diferenca.max(axis=2) > tolerancia)) / diferenca.shape[0] / diferenca.shape[1], 6)}
+    return resultado
+
+def verificar_blur(imagens):
+    # Erro de cada qualidade de blur face a 'exata', para cada imagem {nome: path} em todos os tamanhos de saída
+    imagens = {nome: app.carregar_imagem(path, cv2.IMREAD_COLOR) for nome, path in imagens.items()}
+    resultado = {}
+    for format_key in app.FORMAT_ASSETS:
+        final_dimensions = tuple(map(int, format_key.split('x')))
+        for nome, imagem in imagens.items():
+            for blur in BLUR_KERNELS:
+                exata = app.desfocar_fundo(imagem, final_dimensions, blur, 'exata')
+                for qualidade, limites in app.BLUR_LIMITES_ERRO.items():
+                    diferenca = cv2.absdiff(app.desfocar_fundo(imagem, final_dimensions, blur, qualidade), exata)
+                    erro = {"media": round(float(diferenca.mean()), 4), "p99": int(np.percentile(diferenca, 99)), "max": int(diferenca.max())}
+                    erro["ok"] = all(erro[k] <= limite for k, limite in limites.items())
+                    resultado[f"{format_key}/{nome}/{blur}/{qualidade}"] = erro
+    return resultado
+
+# --- Comparação com o Baseline ---
+
+def metricas_fps(resultado):
+    fps = {}
+    for format_key, funcoes in resultado.get("funcoes", {}).items():
+        for nome, medida in funcoes.items(): fps[f"funcoes/{format_key}/{nome}"] = medida["fps"]
+    for chave, medida in resultado.get("renders", {}).items():
+        if "fps" in medida: fps[f"renders/{chave}"] = medida["fps"]
+    return fps
+
+def comparar_baseline(resultado, baseline, limite):
+    atual, anterior = metricas_fps(resultado), metricas_fps(baseline)
+    comparacao, regressoes = {}, []
+    for chave in sorted(set(atual) & set(anterior)):
+        if not atual[chave] or not anterior[chave]: continue
+        variacao = atual[chave] / anterior[chave] - 1.0
+        comparacao[chave] = {"baseline": anterior[chave], "atual": atual[chave], "variacao": round(variacao, 4)}
+        if variacao < -limite: regressoes.append(chave)
+    params_diferentes = [k for k, h in resultado.get("params", {}).items() if baseline.get("params", {}).get(k, h) != h]
+    return {"limite": limite, "metricas": comparacao, "regressoes": regressoes, "params_diferentes": params_diferentes}
+
+# --- Execução ---
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark reprodutível do motor de renderização.")
+    parser.add_argument('--formatos', nargs='+', default=list(app.FORMAT_ASSETS), choices=list(app.FORMAT_ASSETS))
+    parser.add_argument('--iteracoes', type=int, default=20, help="repetições de cada função medida")
+    parser.add_argument('--sem-render', action='store_true', help="mede só as funções, sem renders completos")
+    parser.add_argument('--saida', default=None, help="ficheiro JSON de resultados (por omissão, output/benchmark/resultado_<data>.json)")
+    parser.add_argument('--baseline', default=os.path.join(BENCH_FOLDER, 'baseline.json'))
+    parser.add_argument('--limite', type=float, default=0.10, help="queda máxima de fps aceite face ao baseline (0.10 = 10%%)")
+    parser.add_argument('--gravar-baseline', action='store_true')
+    parser.add_argument('--referencia', default=os.path.join(BENCH_FOLDER, 'referencia_pixels.npz'))
+    parser.add_argument('--gravar-referencia', action='store_true')
+    parser.add_argument('--tolerancia-pixels', type=int, default=1, help="diferença máxima aceite por canal (0-255)")
+    args = parser.parse_args(argv)
+
+    inicio = time.perf_counter()
+    media = preparar_media()
+    settings_imagem, settings_video = settings_do_benchmark(media['imagem']), settings_do_benchmark(media['video'])
+    resultado = {"data": datetime.now().isoformat(timespec='seconds'), "semente": SEMENTE,
+                 "maquina": {"plataforma": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count(),
+                             "opencv": cv2.__version__, "numpy": np.__version__, "encoder": app.ENCODER_PADRAO['backend']},
+                 "params": {k: hash_params(params_do_formato(settings_imagem, k)) for k in args.formatos},
+                 "funcoes": {}, "renders": {}}
+
+    for format_key in args.formatos:
+        print(f"[benchmark] funções {format_key}", flush=True)
+        resultado["funcoes"][format_key] = benchmark_funcoes(settings_imagem, format_key, media, args.iteracoes)
+    if not args.sem_render:
+        for format_key in args.formatos:
+            for nome, settings in (('imagem', settings_imagem), ('video', settings_video)):
+                print(f"[benchmark] render {format_key} ({nome})", flush=True)
+                resultado["renders"][f"{format_key}/{nome}"] = benchmark_render(settings, format_key)
+
+    falhou = False
+    frames = {}
+    for format_key in args.formatos: frames.update(frames_para_pixels(settings_imagem, format_key, media))
+    if args.gravar_referencia:
+        os.makedirs(os.path.dirname(args.referencia), exist_ok=True)
+        np.savez_compressed(args.referencia, **frames)
+        print(f"[benchmark] referência de pixels gravada em {args.referencia}")
+    elif os.path.exists(args.referencia):
+        with np.load(args.referencia) as referencia:
+            resultado["pixels"] = comparar_pixels(frames, {k: referencia[k] for k in referencia.files}, args.tolerancia_pixels)
+        diferentes = [chave for chave, r in resultado["pixels"].items() if not r["ok"]]
+        print(f"[benchmark] pixels: {len(resultado['pixels']) - len(diferentes)}/{len(resultado['pixels'])} frames dentro da tolerância ({args.tolerancia_pixels})")
+        for chave in diferentes: print(f"  DIFERENTE {chave}: {resultado['pixels'][chave]}")
+        falhou |= bool(diferentes)
+
+    print("[benchmark] qualidades de blur", flush=True)
+    resultado["blur"] = verificar_blur({'sintetica': media['imagem'], 'paisagem': media['paisagem']})
+    fora = [chave for chave, erro in resultado["blur"].items() if not erro["ok"]]
+    print(f"[benchmark] blur: {len(resultado['blur']) - len(fora)}/{len(resultado['blur'])} casos dentro de {app.BLUR_LIMITES_ERRO}")
+    for chave in fora: print(f"  BLUR FORA DO LIMITE {chave}: {resultado['blur'][chave]}")
+    falhou |= bool(fora)
+    # A última mídia enviada pelo editor muda de upload para upload: fica no resultado, mas não decide o exit code
+    user_media = os.path.join(app.BASE_DIR, 'user_media.jpeg')
+    if os.path.exists(user_media):
+        resultado["blur_user_media"] = verificar_blur({'user_media': user_media})
+        fora = [chave for chave, erro in resultado["blur_user_media"].items() if not erro["ok"]]
+        print(f"[benchmark] blur (informativo, user_media.jpeg): {len(resultado['blur_user_media']) - len(fora)}/{len(resultado['blur_user_media'])} casos dentro dos limites")
+
+    if os.path.exists(args.baseline) and not args.gravar_baseline:
+        with open(args.baseline) as f: resultado["comparacao"] = comparar_baseline(resultado, json.load(f), args.limite)
+        for chave in resultado["comparacao"]["regressoes"]:
+            medida = resultado["comparacao"]["metricas"][chave]
+            print(f"  REGRESSÃO {chave}: {medida['baseline']} -> {medida['atual']} fps ({medida['variacao']:+.1%})")
+        if resultado["comparacao"]["params_diferentes"]:
+            print(f"  aviso: layout diferente do baseline em {resultado['comparacao']['params_diferentes']}")
+        falhou |= bool(resultado["comparacao"]["regressoes"])
+
+    resultado["segundos"] = round(time.perf_counter() - inicio, 3)
+    resultado["pico_rss_mb"] = pico_rss_mb()
+    saida = args.saida or os.path.join(BENCH_FOLDER, f"resultado_{datetime.now().strftime('%d%m%Y_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(saida)), exist_ok=True)
+    with open(saida, 'w') as f: json.dump(resultado, f, indent=2, ensure_ascii=False)
+    if args.gravar_baseline:
+        with open(args.baseline, 'w') as f: json.dump(resultado, f, indent=2, ensure_ascii=False)
+
+    for format_key, funcoes in resultado["funcoes"].items():
+        print(f"{format_key}: " + ", ".join(f"{nome} {medida['fps']} fps" for nome, medida in funcoes.items()))
+    for chave, medida in resultado["renders"].items():
+        print(f"{chave}: " + (f"{medida['fps']} fps, {medida['segundos']} s, pico RSS {medida['pico_rss_mb']} MB" if "fps" in medida else f"erro: {medida['erro']}"))
+    print(f"[benchmark] {resultado['segundos']} s, resultados em {saida}")
+    return 1 if falhou else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
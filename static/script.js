@@ -1,5 +1,8 @@
 // Variáveis globais para gerir o estado da aplicação
-let fullSettings = {}, currentFormat = '1920x1080', isMediaUploaded = false;
+let fullSettings = {}, currentFormat = '1920x1080', isMediaUploaded = false, previewObjectUrl = null, previewRequestId = 0;
+// Identifica esta janela junto do servidor, que guarda as camadas já calculadas do preview por sessão
+const previewSession = sessionStorage.getItem('previewSession') || `sess-${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+sessionStorage.setItem('previewSession', previewSession);
 
 // Referências a elementos do DOM
 const form = document.getElementById('videoForm');
@@ -126,14 +129,22 @@ async function updatePreview() {
     
     const formData = new FormData(form);
     formData.append('format', currentFormat);
+    formData.append('previewSession', previewSession);
     document.querySelectorAll('.control-input-global').forEach(input => formData.append(input.name, input.value));
 
+    // Os previews já não são serializados no servidor: ignora respostas que cheguem fora de ordem
+    const requestId = ++previewRequestId;
+
     try {
         const response = await fetch('/preview-frame', {method: 'POST', body: formData});
-        const result = await response.json();
-        if (!response.ok) throw new Error(result.error);
+        if (!response.ok) throw new Error((await response.json()).error);
+        const blob = await response.blob();
+        if (requestId !== previewRequestId) return;
         
-        previewImage.src = `${result.previewUrl}?t=${new Date().getTime()}`;
+        // O servidor devolve o JPEG diretamente; liberta o preview anterior
+        if (previewObjectUrl) URL.revokeObjectURL(previewObjectUrl);
+        previewObjectUrl = URL.createObjectURL(blob);
+        previewImage.src = previewObjectUrl;
         previewImage.classList.remove('hidden');
         previewPlaceholder.classList.add('hidden');
         previewStatus.textContent = "Preview atualizado.";
@@ -280,6 +291,65 @@ userMediaInput.addEventListener('change', async function() {
     }
 });
 
+// --- Geração de Vídeos (jobs assíncronos) ---
+const JOB_POLL_INTERVAL = 1500;
+let currentJobId = null;
+
+function renderDownloadLinks(result) {
+    let downloadLinksHTML = '<div class="space-y-3">';
+    
+    result.downloadUrls.forEach(item => {
+        if(item.error) {
+            downloadLinksHTML += `<p class="text-red-500 font-semibold">Falha ao gerar ${item.label}</p>`;
+        } else {
+            downloadLinksHTML += `<a href="${item.url}" target="_blank" class="block bg-gray-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-gray-700 transition">Download ${item.label}${item.cache ? ' (sem alterações)' : ''}</a>`;
+        }
+    });
+
+    if (result.zipUrl) {
+        downloadLinksHTML += `<hr class="my-4 border-gray-300 dark:border-gray-600">`;
+        downloadLinksHTML += `<a href="${result.zipUrl}" target="_blank" class="block bg-[#005291] text-white font-bold py-3 px-4 rounded-lg hover:bg-[#003c6b] transition text-lg">Descarregar Todos (.zip)</a>`;
+    }
+    
+    downloadLinksHTML += '</div>';
+    statusDiv.innerHTML = downloadLinksHTML;
+}
+
+function renderJobProgress(job) {
+    const statusLabels = {queued: 'Em fila', rendering: 'A renderizar', done: 'Concluído', cached: 'Sem alterações', error: 'Erro', cancelled: 'Cancelado'};
+    let html = `<div class="space-y-2 text-left">`;
+    html += `<p class="font-semibold text-blue-600 dark:text-blue-400 text-center">${job.status === 'queued' ? 'Na fila de renderização...' : `A processar todos os formatos... ${Math.round(job.progress * 100)}%`}</p>`;
+    Object.entries(job.formats).forEach(([label, format]) => {
+        const percent = format.totalFrames ? Math.round(100 * format.frame / format.totalFrames) : 0;
+        html += `<div><div class="flex justify-between text-sm text-gray-700 dark:text-gray-300"><span>${label}</span><span>${statusLabels[format.status] || format.status}</span></div>`;
+        html += `<div class="w-full h-2 bg-gray-200 dark:bg-gray-700 rounded"><div class="h-2 rounded ${format.status === 'error' ? 'bg-red-500' : 'bg-[#005291]'}" style="width: ${percent}%"></div></div></div>`;
+    });
+    html += `<button type="button" id="cancelJobBtn" class="w-full mt-2 bg-gray-500 text-white font-bold py-2 px-4 rounded-lg hover:bg-gray-600 transition">Cancelar</button></div>`;
+    statusDiv.innerHTML = html;
+    document.getElementById('cancelJobBtn').addEventListener('click', cancelCurrentJob);
+}
+
+async function cancelCurrentJob() {
+    if (!currentJobId) return;
+    try { await fetch(`/render-jobs/${currentJobId}/cancel`, {method: 'POST'}); }
+    catch (e) { console.error("Falha ao cancelar o job:", e); }
+}
+
+async function pollJob(jobId) {
+    while (true) {
+        const response = await fetch(`/render-jobs/${jobId}`);
+        const job = await response.json();
+        if (!response.ok) throw new Error(job.error);
+
+        if (job.status === 'done') return job;
+        if (job.status === 'error') throw new Error(job.error);
+        if (job.status === 'cancelled') throw new Error('Renderização cancelada.');
+
+        renderJobProgress(job);
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL));
+    }
+}
+
 generateBtn.addEventListener('click', async function() {
     if (!isMediaUploaded) {
         statusDiv.innerHTML = `<p class="text-red-500">Por favor, carregue a Mídia de Fundo primeiro.</p>`;
@@ -287,38 +357,24 @@ generateBtn.addEventListener('click', async function() {
     }
     
     this.disabled = true;
-    statusDiv.innerHTML = `<div class="flex items-center justify-center text-blue-600 dark:text-blue-400"><svg class="animate-spin -ml-1 mr-3 h-5 w-5" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24"><circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle><path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4z"></path></svg><p>A processar todos os formatos...</p></div>`;
+    statusDiv.innerHTML = `<div class="flex items-center justify-center text-blue-600 dark:text-blue-400"><svg class="animate-spin -ml-1 mr-3 h-5 w-5" xmlns="http://www.w3.org/2000/svg" fill="none" viewBox="0 0 24 24"><circle class="opacity-25" cx="12" cy="12" r="10" stroke="currentColor" stroke-width="4"></circle><path class="opacity-75" fill="currentColor" d="M4 12a8 8 0 018-8V0C5.373 0 0 5.373 0 12h4z"></path></svg><p>A enviar para a fila de renderização...</p></div>`;
     
     saveControls();
     await saveSettingsToServer();
 
     try {
-        const response = await fetch('/generate-video', {method: 'POST'});
-        const result = await response.json();
-        if (!response.ok) throw new Error(result.error);
-        
-        let downloadLinksHTML = '<div class="space-y-3">';
-        
-        result.downloadUrls.forEach(item => {
-            if(item.error) {
-                downloadLinksHTML += `<p class="text-red-500 font-semibold">Falha ao gerar ${item.label}</p>`;
-            } else {
-                downloadLinksHTML += `<a href="${item.url}" target="_blank" class="block bg-gray-600 text-white font-bold py-2 px-4 rounded-lg hover:bg-gray-700 transition">Download ${item.label}</a>`;
-            }
-        });
+        const response = await fetch('/render-jobs', {method: 'POST'});
+        const submitted = await response.json();
+        if (!response.ok) throw new Error(submitted.error);
 
-        if (result.zipUrl) {
-            downloadLinksHTML += `<hr class="my-4 border-gray-300 dark:border-gray-600">`;
-            downloadLinksHTML += `<a href="${result.zipUrl}" target="_blank" class="block bg-[#005291] text-white font-bold py-3 px-4 rounded-lg hover:bg-[#003c6b] transition text-lg">Descarregar Todos (.zip)</a>`;
-        }
-        
-        downloadLinksHTML += '</div>';
-        statusDiv.innerHTML = downloadLinksHTML;
+        currentJobId = submitted.jobId;
+        const result = await pollJob(currentJobId);
+        renderDownloadLinks(result);
 
     } catch (e) {
         statusDiv.innerHTML = `<p class="text-red-500">Erro: ${e.message}</p>`;
     } finally {
+        currentJobId = null;
         this.disabled = false;
     }
 });
-